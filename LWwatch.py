@@ -1,41 +1,149 @@
 import os
 import time
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from difflib import SequenceMatcher
 
+# The observer thread only records events; a scheduler thread waits for each downloaded ini (and the
+# zip it pairs with) to settle and hands the pair to a worker pool, so a slow download never holds
+# up the others. A file has settled once it is closed, or once its size has stayed the same for
+# stable_window seconds with no events for quiet_period seconds.
 class IniFileHandler(FileSystemEventHandler):
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, workers=4, quiet_period=2.0, stable_window=2.0, poll_interval=0.5):
         self.download_dir = download_dir
+        self.quiet_period = quiet_period
+        self.stable_window = stable_window
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.last_event = {}
+        self.sizes = {}
+        self.closed = set()
+        self.pending = {}
+        self.claimed_zips = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lwwatch')
+        self.stopping = threading.Event()
+        self.scheduler = threading.Thread(target=self.schedule_loop, name='lwwatch-scheduler', daemon=True)
+        self.scheduler.start()
+
+    def touch(self, path):
+        with self.lock:
+            self.last_event[path] = time.monotonic()
+            self.closed.discard(path)
+
+    def queue_ini(self, path):
+        # Our own renamed _LW.ini files are results, not new downloads
+        if path.endswith(".ini") and not path.endswith("_LW.ini"):
+            with self.lock:
+                self.pending.setdefault(path, 0.0)
 
     def on_created(self, event):
         if event.is_directory:
             return
-        
-        file_path = event.src_path
-        if file_path.endswith(".ini"):
-            ini_file_name = os.path.basename(file_path)
-            base_name = os.path.splitext(ini_file_name)[0]
-            new_ini_name = base_name + "_LW.ini"
-            new_ini_path = os.path.join(self.download_dir, new_ini_name)
+        self.touch(event.src_path)
+        self.queue_ini(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    # Browsers download to a temporary name and rename it when done
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        self.touch(event.dest_path)
+        self.queue_ini(event.dest_path)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            with self.lock:
+                self.closed.add(event.src_path)
+
+    def schedule_loop(self):
+        while not self.stopping.wait(self.poll_interval):
+            now = time.monotonic()
+            with self.lock:
+                due = [path for path, not_before in self.pending.items() if not_before <= now]
+            for ini_path in due:
+                if not os.path.exists(ini_path):
+                    with self.lock:
+                        self.pending.pop(ini_path, None)
+                    self.forget(ini_path)
+                elif self.is_file_complete(ini_path):
+                    with self.lock:
+                        self.pending.pop(ini_path, None)
+                    self.executor.submit(self.process_ini, ini_path)
+            self.prune(now)
+
+    # Function to put an ini back in the queue to be looked at again after `delay` seconds
+    def requeue(self, ini_path, delay):
+        with self.lock:
+            self.pending[ini_path] = time.monotonic() + delay
+
+    def forget(self, *paths):
+        with self.lock:
+            for path in paths:
+                self.last_event.pop(path, None)
+                self.sizes.pop(path, None)
+                self.closed.discard(path)
+
+    # Function to drop the state of files that have had no events for a while, e.g. the zips we write
+    def prune(self, now, max_age=600):
+        with self.lock:
+            stale = [path for path, seen in self.last_event.items() if now - seen > max_age and path not in self.pending]
+        self.forget(*stale)
+
+    def process_ini(self, file_path):
+        try:
+            self.pair_ini(file_path)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+
+    def pair_ini(self, file_path):
+        ini_file_name = os.path.basename(file_path)
+        base_name = os.path.splitext(ini_file_name)[0]
+        new_ini_name = base_name + "_LW.ini"
+        new_ini_path = os.path.join(self.download_dir, new_ini_name)
+
+        # Find the most similar zip file, leaving out our own output and zips another worker is using
+        zip_files = [f for f in os.listdir(self.download_dir) if f.endswith(".zip") and not f.endswith("_LW.zip")]
+        most_similar_zip = self.find_most_similar_zip(zip_files, base_name) if zip_files else None
+        most_recent_zip_path = os.path.join(self.download_dir, most_similar_zip) if most_similar_zip else None
+        if most_recent_zip_path:
+            with self.lock:
+                claimed = most_recent_zip_path in self.claimed_zips
+                if not claimed:
+                    self.claimed_zips.add(most_recent_zip_path)
+            if claimed:
+                self.requeue(file_path, self.poll_interval)
+                return
+
+        try:
+            # Wait for the zip to finish downloading without tying up this worker
+            if most_recent_zip_path and not self.is_file_complete(most_recent_zip_path):
+                self.requeue(file_path, self.poll_interval)
+                return
 
             # Retry mechanism to ensure the ini file is not being used
             if not self.rename_file_with_retries(file_path, new_ini_path):
                 print(f"Error: Could not rename {file_path}")
                 return
+            self.forget(file_path)
 
-            # Find the most similar zip file
-            zip_files = [f for f in os.listdir(self.download_dir) if f.endswith(".zip")]
-            if not zip_files:
-                return
-
-            most_similar_zip = self.find_most_similar_zip(zip_files, base_name)
-            if most_similar_zip:
-                most_recent_zip_path = os.path.join(self.download_dir, most_similar_zip)
+            if most_recent_zip_path:
+                self.process_zip_file(most_recent_zip_path, new_ini_path, base_name + "_LW")
+                self.forget(most_recent_zip_path)
+        finally:
+            if most_recent_zip_path:
+                with self.lock:
+                    self.claimed_zips.discard(most_recent_zip_path)
 
-                if self.is_file_complete(most_recent_zip_path):
-                    self.process_zip_file(most_recent_zip_path, new_ini_path, base_name + "_LW")
+    def shutdown(self):
+        self.stopping.set()
+        self.scheduler.join()
+        self.executor.shutdown(wait=True)
 
     def rename_file_with_retries(self, old_path, new_path, retries=10, delay=2):
         for _ in range(retries):
@@ -46,10 +154,22 @@ class IniFileHandler(FileSystemEventHandler):
                 time.sleep(delay)
         return False
 
+    # Function to check, without waiting, whether a file has settled. The first look at a new size
+    # only starts its stable window.
     def is_file_complete(self, file_path):
-        initial_size = os.path.getsize(file_path)
-        time.sleep(2)  # Wait for 2 seconds
-        return os.path.getsize(file_path) == initial_size
+        now = time.monotonic()
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return False
+        with self.lock:
+            seen = self.sizes.get(file_path)
+            if seen is None or seen[0] != size:
+                self.sizes[file_path] = (size, now)
+                return False
+            if file_path in self.closed:
+                return True
+            return now - seen[1] >= self.stable_window and now - self.last_event.get(file_path, 0.0) >= self.quiet_period
 
     def process_zip_file(self, zip_path, ini_file_path, new_base_name):
         try:
@@ -106,6 +226,7 @@ def monitor_download_folder(download_dir):
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.shutdown()
 
 if __name__ == "__main__":
     download_directory = r"W:\Mega\LW Tables"
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import urllib.request
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import lists
+
+# Load test for lists.py: builds a synthetic PupDatabase.db, serves it with the production server
+# (or points at one already running) and drives /get_values and /get_games from concurrent clients,
+# reporting requests per second and p50/p99 latency per endpoint and column type. The request mix
+# repeats a small set of URLs, so by default it mostly measures the response cache; --no-cache makes
+# every URL unique so each request runs the query.
+
+manufacturers = ["Williams", "Bally", "Gottlieb", "Stern", "Data East", "Sega", "Midway", "Zaccaria",
+                 "Capcom", "Atari", "Chicago Coin", "Premier", "Jersey Jack", "Spooky", "Original"]
+game_types = ["SS", "EM", "PM", "DMD", "Original"]
+theme_colors = ["Red", "Blue", "Green", "Black", "Gold", "Purple", "Orange"]
+
+def vocabulary(prefix, size):
+    return [f"{prefix} {i}" for i in range(1, size + 1)]
+
+# Vocabularies for the comma-separated columns, drawn with a skew so a few values are very common
+split_vocabularies = {
+    "TAGS": vocabulary("Tag", 200),
+    "Author": vocabulary("Author", 300),
+    "DesignedBy": vocabulary("Designer", 150),
+    "Category": vocabulary("Category", 30),
+    "GameTheme": vocabulary("Theme", 60),
+}
+split_item_counts = {"TAGS": (1, 6), "Author": (1, 3), "DesignedBy": (1, 2), "Category": (1, 2), "GameTheme": (1, 3)}
+
+def skewed_sample(rng, values, count):
+    picked = set()
+    while len(picked) < count:
+        picked.add(values[min(int(rng.paretovariate(1.2)) - 1, len(values) - 1)])
+    return sorted(picked)
+
+# Function to write a Games table of `rows` synthetic games with every valid column filled in
+def generate_database(db_path, rows, seed=1):
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    other_columns = [column for column in lists.valid_columns if column != "GameYear"]
+    conn.execute(f"CREATE TABLE Games (GameID INTEGER PRIMARY KEY, GameName TEXT, GameFileName TEXT, EMUID INTEGER, GameYear INTEGER, "
+                 f"{', '.join(f'{column} TEXT' for column in other_columns)})")
+    games = []
+    for game_id in range(1, rows + 1):
+        row = {"GameName": f"Synthetic Table {game_id}", "GameFileName": f"Synthetic Table {game_id}.vpx", "EMUID": 1,
+               "GameYear": rng.randint(1960, 2024)}
+        for column in other_columns:
+            if column in split_vocabularies:
+                low, high = split_item_counts[column]
+                row[column] = ", ".join(skewed_sample(rng, split_vocabularies[column], rng.randint(low, high)))
+            elif column == "Manufact":
+                row[column] = rng.choice(manufacturers)
+            elif column == "NumPlayers":
+                row[column] = str(rng.randint(1, 4))
+            elif column == "GameType":
+                row[column] = rng.choice(game_types)
+            elif column == "ThemeColor":
+                row[column] = rng.choice(theme_colors)
+            else:
+                # Sparse free-form columns, mostly empty as in a real library
+                row[column] = rng.choice(["", "", "", None, f"{column.lower()} {rng.randint(1, 20)}"])
+        games.append(row)
+    columns = list(games[0])
+    conn.executemany(f"INSERT INTO Games ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                     [[game[column] for column in columns] for game in games])
+    conn.commit()
+    conn.close()
+
+# Function to serve the synthetic database from this process with the production server
+def start_local_server(db_path, work_dir, port, threads):
+    lists.db = lists.get_pool(db_path)
+    lists.facet_index = lists.FacetIndex(lists.db, lists.GameValueSidecar(os.path.join(work_dir, 'game_values.db')))
+    lists.facet_index.values(lists.valid_columns[0])
+    server = threading.Thread(target=lists.serve, args=('127.0.0.1', port, threads), daemon=True)
+    server.start()
+    return f"http://127.0.0.1:{port}"
+
+def wait_for_server(base_url, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(base_url + '/get_values?column=GameYear').read()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+def fetch_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+# Function to build the request mix: (label, url) pairs spread over both endpoints and column types.
+# With bust_cache each URL gets a unique extra parameter, which the server ignores but which gives
+# every request its own ETag, so none is answered from the response cache.
+def build_requests(base_url, count, seed=2, bust_cache=False):
+    rng = random.Random(seed)
+    facets = {column: [value for value, _ in fetch_json(f"{base_url}/get_values?column={urllib.parse.quote(column)}")]
+              for column in lists.valid_columns}
+    columns = [column for column in lists.valid_columns if facets[column]]
+    requests = []
+    for _ in range(count):
+        column = rng.choice(columns)
+        kind = 'split' if column in lists.split_columns else 'plain'
+        if rng.random() < 0.5:
+            requests.append((f"/get_values {kind}", f"{base_url}/get_values?column={urllib.parse.quote(column)}"))
+        else:
+            values = rng.sample(facets[column], min(len(facets[column]), rng.randint(1, 3)))
+            query = urllib.parse.urlencode([('column', column)] + [('values', value) for value in values])
+            requests.append((f"/get_games {kind}", f"{base_url}/get_games?{query}"))
+    if bust_cache:
+        requests = [(label, f"{url}&nocache={i}") for i, (label, url) in enumerate(requests)]
+    return requests
+
+def timed_request(url):
+    start = time.perf_counter()
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+# Function to run each endpoint and column type as its own phase, so its requests per second are measured
+# on their own, then print one row per phase
+def run_benchmark(requests, clients):
+    phases = {}
+    for label, url in requests:
+        phases.setdefault(label, []).append(url)
+
+    print(f"{'endpoint':<22}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    total_requests = 0
+    total_time = 0.0
+    for label, urls in sorted(phases.items()):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            latencies = sorted(executor.map(timed_request, urls))
+        wall_time = time.perf_counter() - start
+        total_requests += len(urls)
+        total_time += wall_time
+        print(f"{label:<22}{len(urls):>10}{len(urls) / wall_time:>10.0f}"
+              f"{percentile(latencies, 0.50) * 1000:>10.2f}{percentile(latencies, 0.99) * 1000:>10.2f}")
+    print(f"{total_requests} requests from {clients} clients in {total_time:.2f}s ({total_requests / total_time:.0f} req/s overall)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the playlist tool endpoints against a synthetic PupDatabase.db')
+    parser.add_argument('--rows', type=int, default=2000, help='Games in the synthetic database')
+    parser.add_argument('--requests', type=int, default=2000, help='Total requests to send')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client threads')
+    parser.add_argument('--threads', type=int, default=8, help='Server request threads for the local server')
+    parser.add_argument('--port', type=int, default=5099, help='Port for the local server')
+    parser.add_argument('--db', help='Keep the synthetic database at this path instead of a temporary directory')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting one (no database is generated)')
+    parser.add_argument('--no-cache', action='store_true', help='Make every request URL unique so none is answered from the response cache')
+    args = parser.parse_args()
+
+    work_dir = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            work_dir = tempfile.mkdtemp(prefix='lists_benchmark_')
+            db_path = args.db or os.path.join(work_dir, 'PupDatabase.db')
+            start = time.perf_counter()
+            generate_database(db_path, args.rows)
+            print(f"Generated {args.rows} games in {db_path} ({time.perf_counter() - start:.2f}s)")
+            base_url = start_local_server(db_path, work_dir, args.port, args.threads)
+        wait_for_server(base_url)
+
+        requests = build_requests(base_url, args.requests, bust_cache=args.no_cache)
+        run_benchmark(requests, args.clients)
+    finally:
+        # The sidecar (and the database, unless --db kept it elsewhere) only lived for this run
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,45 @@
 from flask import Flask, render_template, request, jsonify
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import atexit
+import hashlib
 import sqlite3
 import logging
-from collections import Counter
+import argparse
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from collections import Counter, OrderedDict
+from itertools import chain
+
+# popper_db.py is shared with the scripts one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from popper_db import get_pool
 
 app = Flask(__name__)
 db_path = 'C:/vPinball/PinUPSystem/PupDatabase.db'
+db = get_pool(db_path)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(message)s',
-                    handlers=[
-                        logging.FileHandler("debug.log"),
-                        logging.StreamHandler()
-                    ])
+# Configure logging. Records go through a queue so request threads never wait on the log file;
+# a listener thread writes them to debug.log and the console.
+def configure_logging(level):
+    log_queue = queue.Queue()
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    handlers = [logging.FileHandler("debug.log"), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    # The queue side only passes the message on; the listener's handlers add the timestamp and level
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler])
 
 # List of valid columns for selection
 valid_columns = [
@@ -24,43 +51,143 @@ valid_columns = [
 # Columns that need splitting
 split_columns = ["TAGS", "Author", "DesignedBy", "Category", "GameTheme"]
 
+# Whitespace trimmed from each split item, here and in the generated SQL, so both find the same items
+item_whitespace = ' \t\r\n'
+item_whitespace_sql = "' ' || char(9) || char(13) || char(10)"
+
+# Function to put facet values in the order SQLite's ORDER BY gives them: numbers before text
+def facet_sort_key(item):
+    return (isinstance(item[0], (str, bytes)), item[0])
+
+# Derived game -> value junction table for the split columns, kept in a sidecar database next to this
+# script so PupDatabase.db is only ever read. Lookups are exact, indexed matches on a single value
+# rather than LIKE scans that let "Star" match "Star Wars".
+class GameValueSidecar:
+    def __init__(self, sidecar_path):
+        self.sidecar_path = sidecar_path
+
+    def rebuild(self, games, pairs):
+        conn = sqlite3.connect(self.sidecar_path)
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS games (game_id INTEGER PRIMARY KEY, game_name TEXT)")
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS game_values (
+                    column_name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    game_id INTEGER NOT NULL,
+                    PRIMARY KEY (column_name, value, game_id)
+                ) WITHOUT ROWID
+                """)
+                conn.execute("DELETE FROM games")
+                conn.execute("DELETE FROM game_values")
+                conn.executemany("INSERT INTO games (game_id, game_name) VALUES (?, ?)", games)
+                conn.executemany("INSERT OR IGNORE INTO game_values (column_name, value, game_id) VALUES (?, ?, ?)", pairs)
+        finally:
+            conn.close()
+        logging.debug(f"Rebuilt game value sidecar with {len(pairs)} entries")
+
+    # Function to return the names of games carrying any of the values in a split column
+    def games_with_any(self, column, values):
+        placeholders = ','.join('?' for _ in values)
+        query = f"""
+        SELECT DISTINCT g.game_name
+        FROM game_values v JOIN games g ON g.game_id = v.game_id
+        WHERE v.column_name = ? AND v.value IN ({placeholders})
+        ORDER BY g.game_name
+        """
+        conn = sqlite3.connect(self.sidecar_path)
+        try:
+            return [row[0] for row in conn.execute(query, [column] + [str(value) for value in values])]
+        finally:
+            conn.close()
+
+# In-memory (value, count) lists for every valid column, built with one pass over the Games table.
+# The same pass keeps a columnar snapshot of the table for /query and refreshes the game value sidecar. Both are rebuilt when PupDatabase.db's mtime or
+# PRAGMA data_version changes; data_version catches writes that are still sitting in the WAL and
+# haven't touched the file's mtime yet.
+class FacetIndex:
+    def __init__(self, db, sidecar):
+        self.db = db
+        self.sidecar = sidecar
+        self.lock = threading.Lock()
+        self.conn = None
+        self.version = None
+        self.facets = {}
+        self.snapshot = None
+
+    def current_version(self):
+        # data_version only moves for commits made by other connections, so this one is kept open
+        if self.conn is None:
+            self.conn = self.db.connect(check_same_thread=False)
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        return (os.stat(self.db.db_path).st_mtime_ns, data_version)
+
+    def build(self):
+        logging.debug("Building facet index")
+        counters = {column: Counter() for column in valid_columns}
+        # Split columns hold a tuple of items per game, other columns the raw value (None when empty)
+        columns = {column: [] for column in valid_columns}
+        games = []
+        pairs = []
+        rows = self.db.query(f"SELECT rowid, GameName, {', '.join(valid_columns)} FROM Games")
+        for game_id, game_name, *row in rows:
+            games.append((game_id, game_name))
+            for column, value in zip(valid_columns, row):
+                if value is None or value == '':
+                    columns[column].append(() if column in split_columns else None)
+                    continue
+                if column in split_columns:
+                    # Stray commas leave empty items behind, which aren't values anyone can pick
+                    items = tuple(item for item in (part.strip(item_whitespace) for part in str(value).split(",")) if item)
+                    counters[column].update(items)
+                    pairs.extend((column, item, game_id) for item in items)
+                    columns[column].append(items)
+                else:
+                    counters[column][value] += 1
+                    columns[column].append(value)
+        self.sidecar.rebuild(games, pairs)
+        facets = {column: sorted(counter.items(), key=facet_sort_key) for column, counter in counters.items()}
+        logging.debug(f"Built facet index for {len(facets)} columns")
+        keys = {column: [None if value is None else str(value) for value in columns[column]]
+                for column in valid_columns if column not in split_columns}
+        return facets, {'GameName': [game_name for _, game_name in games], 'columns': columns, 'keys': keys}
+
+    # Function to rebuild the index and sidecar if the database has changed since the last build
+    def refresh(self):
+        with self.lock:
+            self.refresh_locked()
+            return self.facets
+
+    def refresh_locked(self):
+        # Read the version before building so a write that lands mid-build triggers another rebuild
+        version = self.current_version()
+        if version != self.version:
+            self.facets, self.snapshot = self.build()
+            self.version = version
+
+    def values(self, column):
+        return self.refresh().get(column, [])
+
+    # Function to return the version the current index was built from, rebuilding first if it is stale
+    def current_version_built(self):
+        with self.lock:
+            self.refresh_locked()
+            return self.version
+
+    def current_snapshot(self):
+        with self.lock:
+            self.refresh_locked()
+            return self.snapshot
+
+facet_index = FacetIndex(db, GameValueSidecar(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'game_values.db')))
+
 def get_column_values_with_counts(column):
     if column not in valid_columns:
         logging.warning(f"Invalid column: {column}")
         return []
     logging.debug(f"Fetching values for column: {column}")
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    if column in split_columns:
-        query = f"SELECT {column} FROM Games WHERE {column} IS NOT NULL AND {column} != ''"
-    else:
-        query = f"""
-        SELECT {column}, COUNT(*) as ItemCount 
-        FROM Games 
-        WHERE {column} IS NOT NULL AND {column} != ''
-        GROUP BY {column} 
-        HAVING COUNT(*) > 0
-        ORDER BY {column}
-        """
-    
-    logging.debug(f"Executing query: {query}")
-    cursor.execute(query)
-    results = cursor.fetchall()
-    conn.close()
-
-    if column in split_columns:
-        values_counter = Counter()
-        for row in results:
-            items = [item.strip() for item in row[0].split(",")]
-            values_counter.update(items)
-        
-        values = [(tag, count) for tag, count in values_counter.items()]
-        values.sort(key=lambda x: x[0])
-    else:
-        values = results
-    
+    values = facet_index.values(column)
     logging.debug(f"Fetched {len(values)} values for column: {column}")
     return values
 
@@ -70,49 +197,250 @@ def get_games_by_column(column, values):
         return []
     logging.debug(f"Fetching games for column: {column} with values: {values}")
     
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     if column in split_columns:
-        query_fragments = [f"{column} LIKE ?" for _ in values]
-        query = f"SELECT GameName FROM Games WHERE {' OR '.join(query_fragments)}"
-        like_values = [f"%{value}%" for value in values]
-        logging.debug(f"Executing query: {query} with values: {like_values}")
-        cursor.execute(query, like_values)
+        # Make sure the sidecar reflects the current Games table before matching against it
+        facet_index.refresh()
+        games = facet_index.sidecar.games_with_any(column, values)
     else:
         placeholders = ','.join('?' for _ in values)
         query = f"SELECT GameName FROM Games WHERE {column} IN ({placeholders})"
         logging.debug(f"Executing query: {query} with values: {values}")
-        cursor.execute(query, values)
-    
-    games = [row[0] for row in cursor.fetchall()]
-    conn.close()
+        games = db.query_values(query, values)
     
-    # Remove duplicates
-    games = list(set(games))
+        # Remove duplicates
+        games = list(set(games))
     
     logging.debug(f"Fetched {len(games)} games for column: {column} with values: {values}")
     return games
 
+# Function to quote a value for the generated Popper SQL
+def sql_literal(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Function to test one item of a split column in SQL: a recursive CTE splits the value on commas and
+# trims each item the same way the facet index does, so only whole items match
+def split_item_sql(column, value):
+    return (f"EXISTS (WITH RECURSIVE items(item, rest) AS (SELECT NULL, {column} || ',' "
+            f"UNION ALL SELECT substr(rest, 1, instr(rest, ',') - 1), substr(rest, instr(rest, ',') + 1) FROM items WHERE rest <> '') "
+            f"SELECT 1 FROM items WHERE trim(item, {item_whitespace_sql}) = {sql_literal(str(value))})")
+
+# Function to write one /query filter as SQL Popper can run against its own Games table
+def filter_sql(column, values, op):
+    if column in split_columns:
+        tests = [split_item_sql(column, value) for value in values]
+        if op == 'none':
+            return f"({column} IS NULL OR NOT ({' OR '.join(tests)}))"
+        return f"({(' AND ' if op == 'all' else ' OR ').join(tests)})"
+    literals = ', '.join(sql_literal(value) for value in values)
+    if op == 'none':
+        return f"({column} IS NULL OR {column} NOT IN ({literals}))"
+    if op == 'all' and len({str(value) for value in values}) > 1:
+        return "(0)"
+    return f"({column} IN ({literals}))"
+
+query_ops = ('any', 'all', 'none')
+
+# Function to answer a multi-column query from the in-memory snapshot. Filters are AND-ed together;
+# each matches games having any, all or none of its values. One pass over the snapshot finds the
+# matching games, then every column that isn't filtered on is counted over them for drill-down.
+def query_games(filters):
+    if not isinstance(filters, list):
+        raise ValueError(f"filters must be a list, got: {filters!r}")
+    compiled = []
+    for query_filter in filters:
+        if not isinstance(query_filter, dict):
+            raise ValueError(f"Invalid filter: {query_filter!r}")
+        column = query_filter.get('column')
+        values = query_filter.get('values') or []
+        op = query_filter.get('op', 'any')
+        # A single string would otherwise be matched one character at a time
+        if not isinstance(values, list) or not all(isinstance(value, (str, int, float)) for value in values):
+            raise ValueError(f"Invalid filter values: {query_filter!r}")
+        values = [value for value in values if str(value).strip()]
+        if column not in valid_columns or op not in query_ops or not values:
+            raise ValueError(f"Invalid filter: {query_filter}")
+        compiled.append((column, values, op))
+
+    snapshot = facet_index.current_snapshot()
+    columns = snapshot['columns']
+    filtered = {column for column, _, _ in compiled}
+    facet_columns = [column for column in valid_columns if column not in filtered]
+    counters = {column: Counter() for column in facet_columns}
+
+    tests = []
+    for column, values, op in compiled:
+        wanted = {str(value) for value in values}
+        if column in split_columns:
+            data = columns[column]
+            if op == 'any':
+                tests.append(lambda i, data=data, wanted=wanted: not wanted.isdisjoint(data[i]))
+            elif op == 'all':
+                tests.append(lambda i, data=data, wanted=wanted: wanted.issubset(data[i]))
+            else:
+                tests.append(lambda i, data=data, wanted=wanted: wanted.isdisjoint(data[i]))
+        else:
+            # Compare as text, as SQLite does for a quoted value against a numeric column, since
+            # checkbox values always arrive as strings
+            data = snapshot['keys'][column]
+            if op == 'any':
+                tests.append(lambda i, data=data, wanted=wanted: data[i] in wanted)
+            elif op == 'all':
+                tests.append(lambda i, data=data, wanted=wanted: len(wanted) == 1 and data[i] in wanted)
+            else:
+                tests.append(lambda i, data=data, wanted=wanted: data[i] not in wanted)
+
+    names = snapshot['GameName']
+    matched = [i for i in range(len(names)) if all(test(i) for test in tests)]
+    for column in facet_columns:
+        data = columns[column]
+        if column in split_columns:
+            counters[column].update(chain.from_iterable(data[i] for i in matched))
+        else:
+            counters[column].update(data[i] for i in matched)
+            counters[column].pop(None, None)
+    games = {names[i] for i in matched}
+
+    where = ' AND '.join(filter_sql(column, values, op) for column, values, op in compiled)
+    return {
+        'games': sorted(games),
+        'count': len(games),
+        'facets': {column: sorted(counter.items(), key=facet_sort_key) for column, counter in counters.items()},
+        'sql': f"SELECT * FROM Games WHERE {where}" if where else "SELECT * FROM Games",
+    }
+
+# Serialized (plain, gzipped) JSON bodies of recent read responses, keyed by ETag. The ETag covers
+# the database version and the full request, so a change to PupDatabase.db retires every entry.
+class ResponseCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, etag):
+        with self.lock:
+            entry = self.entries.get(etag)
+            if entry is not None:
+                self.entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, entry):
+        with self.lock:
+            self.entries[etag] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+response_cache = ResponseCache()
+# data_version counts restart from scratch in a new process, so ETags from an earlier run never match
+server_token = f"{os.getpid()}-{time.time_ns()}"
+gzip_min_size = 512
+
+# Function to answer a read request from the response cache, computing and compressing it on a miss.
+# compute() returns the JSON payload or raises ValueError for a bad request, which isn't cached.
+def cached_json(compute):
+    version = facet_index.current_version_built()
+    request_key = request.full_path if request.method == 'GET' else request.path + '?' + request.get_data(as_text=True)
+    etag = hashlib.sha1(f"{server_token}:{version}:{request_key}".encode('utf-8')).hexdigest()
+
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    entry = response_cache.get(etag)
+    if entry is None:
+        try:
+            payload = compute()
+        except ValueError as e:
+            logging.warning(f"Bad request to {request.path}: {e}")
+            return jsonify({'error': str(e)}), 400
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        compressed = gzip.compress(body, compresslevel=6) if len(body) >= gzip_min_size else None
+        entry = (body, compressed)
+        response_cache.put(etag, entry)
+
+    body, compressed = entry
+    response = app.response_class(mimetype='application/json')
+    if compressed is not None and 'gzip' in request.accept_encodings:
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(body)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Let the browser keep the body but check back each time; an unchanged database answers 304
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response
+
+# Function to read a request argument from the query string of a GET or the JSON body of a POST
+def request_value(name, default=None, many=False):
+    if request.method == 'GET':
+        if many:
+            return request.args.getlist(name)
+        return request.args.get(name, default)
+    body = request.get_json(silent=True)
+    return body.get(name, default) if isinstance(body, dict) else default
+
 @app.route('/')
 def index():
     return render_template('index.html', columns=valid_columns)
 
-@app.route('/get_values', methods=['POST'])
+@app.route('/get_values', methods=['GET', 'POST'])
 def get_values():
-    column = request.json['column']
+    column = request_value('column')
     logging.info(f"Received request to get values for column: {column}")
-    values = get_column_values_with_counts(column)
-    return jsonify(values)
+    return cached_json(lambda: get_column_values_with_counts(column))
 
-@app.route('/get_games', methods=['POST'])
+@app.route('/get_games', methods=['GET', 'POST'])
 def get_games():
-    column = request.json['column']
-    values = request.json['values']
+    column = request_value('column')
+    values = request_value('values', [], many=True)
     logging.info(f"Received request to get games for column: {column} with values: {values}")
-    games = get_games_by_column(column, values)
-    return jsonify(games)
+    return cached_json(lambda: get_games_by_column(column, values))
+
+@app.route('/query', methods=['GET', 'POST'])
+def query():
+    filters = request_value('filters', [])
+    logging.info(f"Received query with filters: {filters}")
+    # A GET carries the filters as JSON text; a malformed one is a ValueError like any other bad filter
+    return cached_json(lambda: query_games(json.loads(filters) if isinstance(filters, str) else filters))
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+# Request lines are already logged by the endpoints, so the server's own access log is left off
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# Function to serve the app with a multi-threaded WSGI server, using waitress when it is installed
+def serve(host, port, threads):
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        waitress_serve = None
+    if waitress_serve is not None:
+        logging.info(f"Serving with waitress on {host}:{port} ({threads} threads)")
+        waitress_serve(app, host=host, port=port, threads=threads)
+        return
+    logging.info(f"Serving with a threaded wsgiref server on {host}:{port}")
+    server = make_server(host, port, app, server_class=ThreadingWSGIServer, handler_class=QuietRequestHandler)
+    server.serve_forever()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PinUP Popper playlist query builder')
+    parser.add_argument('--debug', action='store_true', help="Run Flask's debug server with DEBUG logging instead of the production server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8, help='Request threads for the production server')
+    args = parser.parse_args()
+
+    configure_logging(logging.DEBUG if args.debug else logging.INFO)
     logging.info("Starting the Flask application")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Build the facet index up front so the first dropdown click doesn't pay for it
+    facet_index.values(valid_columns[0])
+    if args.debug:
+        app.run(debug=True, host=args.host, port=args.port)
+    else:
+        serve(args.host, args.port, args.threads)
@@ -2,20 +2,36 @@ import sqlite3
 import os
 import zipfile
 import sys
-from fnmatch import fnmatch
+import json
+import hashlib
+import argparse
+import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from popper_db import get_pool
 
 # Configuration
 backup_folder = "C:\\vpinball\\Backups"
 db_path = "C:\\vPinball\\PinUPSystem\\PupDatabase.db"
 additional_dirs = ["C:\\vpinball\\PinUPSystem\\PUPVideos", "C:\\vpinball\\PinUPSystem\\POPMedia"]
+store_folder = os.path.join(backup_folder, "store")
+pupvideos_dir = "C:\\vpinball\\PinUPSystem\\PUPVideos"
+cfg_directory = "C:\\vpinball\\FuturePinball"
 emulators = ["Future Pinball", "Visual Pinball X"]
 debug = len(sys.argv) > 1 and sys.argv[1].lower() == 'debug'
 
+# Table and config files compress well; media formats are already compressed and are stored as-is
+deflate_extensions = ['.vpx', '.fpt', '.cfg', '.ini', '.directb2s', '.vbs', '.txt', '.pup']
+write_buffer_size = 4 * 1024 * 1024
+
 # Ensure the backup folder exists
 os.makedirs(backup_folder, exist_ok=True)
 
+# Returns a dedicated tuned read-only connection; the games list is read once, so it isn't pooled
 def connect_db(db_path):
-    return sqlite3.connect(db_path)
+    return get_pool(db_path).connect()
 
 def fetch_games_data(conn):
     cursor = conn.cursor()
@@ -32,14 +48,229 @@ def fetch_games_data(conn):
         return []
     return cursor.fetchall()
 
-def backup_files(files, backup_zip, root_directories):
+def compression_for(file):
+    if os.path.splitext(file)[1].lower() in deflate_extensions:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def backup_files(files, backup_zip, root_directories, compresslevel=6):
+    total_bytes = 0
     for file in files:
         if os.path.exists(file):
             arcname = os.path.relpath(file, start=os.path.commonpath(root_directories + additional_dirs))
             if debug: print(f"Adding {file} as {arcname} to zip")
-            backup_zip.write(file, arcname)
+            backup_zip.write(file, arcname, compress_type=compression_for(file), compresslevel=compresslevel)
+            total_bytes += os.path.getsize(file)
         else:
             if debug: print(f"File does not exist: {file}")
+    return total_bytes
+
+def build_backup(status, backup_zip_path, manifest_path, manifest, files_to_backup, relevant_directories, compresslevel=6):
+    if debug: print(f"Creating backup zip at: {backup_zip_path}")
+    start = time.perf_counter()
+    temp_zip_path = backup_zip_path + '.tmp'
+    with open(temp_zip_path, 'wb', buffering=write_buffer_size) as zip_file:
+        with zipfile.ZipFile(zip_file, 'w') as backup_zip:
+            total_bytes = backup_files(files_to_backup, backup_zip, relevant_directories, compresslevel)
+    os.replace(temp_zip_path, backup_zip_path)
+    save_manifest(manifest_path, manifest)
+    if debug: print(f"Backup {backup_zip_path} completed")
+    return status, threading.current_thread().name, total_bytes, time.perf_counter() - start
+
+# Function to back up one game as a zip, only rebuilding it when its file set or contents changed
+# since the last backup
+def backup_game(backup_zip_path, manifest_path, files_to_backup, relevant_directories, with_hash=False, force=False, compresslevel=6):
+    manifest = build_manifest(files_to_backup, relevant_directories, with_hash=with_hash)
+    exists = os.path.exists(backup_zip_path)
+    if exists and not force and load_manifest(manifest_path) == manifest:
+        if debug: print(f"Backup for {os.path.basename(backup_zip_path)} is up to date")
+        return "Skipped", threading.current_thread().name, 0, 0.0
+    return build_backup("Rebuilt" if exists else "Added", backup_zip_path, manifest_path, manifest, files_to_backup, relevant_directories, compresslevel)
+
+# Function to run the jobs that write the same backup one after another, in the order the games were
+# found, so two games whose file names share a basename never write one archive at the same time.
+# Each job's result or error is kept so one failure doesn't hide the others.
+def run_in_order(jobs):
+    results = []
+    for name, job, job_args in jobs:
+        try:
+            results.append((name, job(*job_args), None))
+        except Exception as e:
+            results.append((name, None, e))
+    return results
+
+# The store format keeps one blob per unique file content under store/blobs, keyed by SHA-256,
+# plus a manifest per game under store/games, so PUP packs shared by several tables are written once
+def blob_path(file_hash, compressed):
+    return os.path.join(store_folder, "blobs", file_hash[:2], file_hash + (".z" if compressed else ""))
+
+def game_manifest_path(game_file_name):
+    return os.path.join(store_folder, "games", f"{game_file_name}.json")
+
+def store_blob(file, file_hash, compressed, compresslevel=6):
+    path = blob_path(file_hash, compressed)
+    if os.path.exists(path):
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    compressor = zlib.compressobj(compresslevel) if compressed else None
+    with open(file, 'rb') as src, open(temp_path, 'wb', buffering=write_buffer_size) as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b''):
+            dst.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            dst.write(compressor.flush())
+    os.replace(temp_path, path)
+    return os.path.getsize(file)
+
+def build_store_backup(game_file_name, files_to_backup, relevant_directories, known_files, force=False, compresslevel=6):
+    start = time.perf_counter()
+    manifest_path = game_manifest_path(game_file_name)
+    manifest = build_manifest(files_to_backup, relevant_directories, with_hash=True, known_files=known_files)
+    for entry in manifest:
+        entry["compressed"] = compression_for(entry["path"]) == zipfile.ZIP_DEFLATED
+
+    previous = load_manifest(manifest_path)
+    if previous == manifest and not force:
+        if debug: print(f"Stored backup for {game_file_name} is up to date")
+        return "Skipped", threading.current_thread().name, 0, time.perf_counter() - start
+
+    total_bytes = 0
+    for entry in manifest:
+        if debug: print(f"Storing {entry['path']} as {entry['hash']}")
+        total_bytes += store_blob(entry["path"], entry["hash"], entry["compressed"], compresslevel)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    save_manifest(manifest_path, manifest)
+    if debug: print(f"Stored backup for {game_file_name} completed")
+    return "Added" if previous is None else "Rebuilt", threading.current_thread().name, total_bytes, time.perf_counter() - start
+
+# Hashes from earlier game manifests are reused for files whose size and mtime haven't changed
+def load_known_files():
+    known_files = {}
+    games_folder = os.path.join(store_folder, "games")
+    if os.path.isdir(games_folder):
+        for entry in os.scandir(games_folder):
+            for file_entry in load_manifest(entry.path) or []:
+                known_files[file_entry["path"]] = file_entry
+    return known_files
+
+def restore_game(game_file_name, restore_to=None):
+    manifest = load_manifest(game_manifest_path(game_file_name))
+    if manifest is None:
+        print(f"No stored backup found for {game_file_name}")
+        return
+
+    for entry in manifest:
+        target = os.path.join(restore_to, entry["arcname"]) if restore_to else entry["path"]
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        decompressor = zlib.decompressobj() if entry["compressed"] else None
+        with open(blob_path(entry["hash"], entry["compressed"]), 'rb') as src, open(target, 'wb', buffering=write_buffer_size) as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                dst.write(decompressor.decompress(chunk) if decompressor else chunk)
+            if decompressor:
+                dst.write(decompressor.flush())
+        os.utime(target, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        if debug: print(f"Restored {target}")
+    print(f"Restored {len(manifest)} files for {game_file_name}")
+
+# Scans a directory tree once with os.scandir and indexes every file for per-game lookups.
+# A file named "a.b.png" is indexed under the stems "a" and "a.b", the same files fnmatch(file, f"{stem}.*")
+# matched. Keys are normcased to keep Windows' case-insensitive matching, and each path keeps its scan
+# position so lookups return files in top-down walk order.
+class FileIndex:
+    def __init__(self, root):
+        self.by_stem = defaultdict(list)
+        self.by_name = defaultdict(list)
+        self.by_top_dir = defaultdict(list)
+        position = 0
+
+        if debug: print(f"Indexing directory: {root}")
+        stack = [(root, None)]
+        while stack:
+            directory, top_dir = stack.pop()
+            try:
+                entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+            except OSError as e:
+                if debug: print(f"Error: {e}")
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirectories.append((entry.path, top_dir if top_dir is not None else os.path.normcase(entry.name)))
+                    continue
+
+                item = (position, entry.path)
+                position += 1
+                name = os.path.normcase(entry.name)
+                for i, char in enumerate(name):
+                    if char == '.':
+                        self.by_stem[name[:i]].append(item)
+                self.by_name[name].append(item)
+                if top_dir is not None:
+                    self.by_top_dir[top_dir].append(item)
+
+            stack.extend(reversed(subdirectories))
+
+    def find_stems(self, *stems):
+        items = set()
+        for stem in stems:
+            if stem:
+                items.update(self.by_stem.get(os.path.normcase(stem), ()))
+        return [path for _, path in sorted(items)]
+
+    def find_name(self, name):
+        return [path for _, path in self.by_name.get(os.path.normcase(name), ())]
+
+    def find_top_dir(self, top_dir):
+        return [path for _, path in self.by_top_dir.get(os.path.normcase(top_dir), ())]
+
+file_indexes = {}
+
+def get_file_index(directory):
+    if directory not in file_indexes:
+        file_indexes[directory] = FileIndex(directory)
+    return file_indexes[directory]
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The manifest lists every file in a game's zip with its size, mtime and optionally a content hash
+def build_manifest(files, root_directories, with_hash=False, known_files=None):
+    manifest = []
+    for file in files:
+        if not os.path.exists(file):
+            continue
+        stat = os.stat(file)
+        entry = {
+            "path": file,
+            "arcname": os.path.relpath(file, start=os.path.commonpath(root_directories + additional_dirs)),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        if with_hash:
+            known = (known_files or {}).get(file)
+            if known and known["size"] == entry["size"] and known["mtime_ns"] == entry["mtime_ns"] and "hash" in known:
+                entry["hash"] = known["hash"]
+            else:
+                entry["hash"] = file_hash(file)
+        manifest.append(entry)
+    return manifest
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
 
 def get_files_to_backup(game_file, rom_file, dir_games):
     files_to_backup = []
@@ -51,42 +282,54 @@ def get_files_to_backup(game_file, rom_file, dir_games):
     # Search in the main directories
     for directory in relevant_directories:
         if debug: print(f"Searching in directory: {directory}")
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if fnmatch(file, f"{base_game_file}.*") or (rom_file and fnmatch(file, f"{rom_file}.*")):
-                    file_path = os.path.join(root, file)
-                    if debug: print(f"Found file to backup: {file_path}")
-                    files_to_backup.append(file_path)
+        for file_path in get_file_index(directory).find_stems(base_game_file, rom_file):
+            if debug: print(f"Found file to backup: {file_path}")
+            files_to_backup.append(file_path)
 
     # Specific search for Future Pinball cfg files
     if os.path.splitext(game_file)[1] == '.fpt':
-        cfg_directory = "C:\\vpinball\\FuturePinball"
         if debug: print(f"Searching for cfg files in directory: {cfg_directory}")
-        for root, _, files in os.walk(cfg_directory):
-            for file in files:
-                if fnmatch(file, f"{base_game_file}.cfg"):
-                    file_path = os.path.join(root, file)
-                    if debug: print(f"Found Future Pinball cfg file to backup: {file_path}")
-                    files_to_backup.append(file_path)
+        for file_path in get_file_index(cfg_directory).find_name(f"{base_game_file}.cfg"):
+            if debug: print(f"Found Future Pinball cfg file to backup: {file_path}")
+            files_to_backup.append(file_path)
 
     # Search for PUPVideo files in specific ROM directory
     if rom_file:
-        pupvideos_directory = os.path.join("C:\\vpinball\\PinUPSystem\\PUPVideos", rom_file)
-        if os.path.isdir(pupvideos_directory):
-            if debug: print(f"Searching for video files in directory: {pupvideos_directory}")
-            for root, _, files in os.walk(pupvideos_directory):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if debug: print(f"Found video file to backup: {file_path}")
-                    files_to_backup.append(file_path)
+        if debug: print(f"Searching for video files in directory: {os.path.join(pupvideos_dir, rom_file)}")
+        for file_path in get_file_index(pupvideos_dir).find_top_dir(rom_file):
+            if debug: print(f"Found video file to backup: {file_path}")
+            files_to_backup.append(file_path)
 
     return files_to_backup, relevant_directories
 
 def main():
+    parser = argparse.ArgumentParser(description='Back up table files, media and PUP packs into one zip per game.')
+    parser.add_argument('debug', nargs='?', help="Pass 'debug' to print every file considered")
+    parser.add_argument('--force', action='store_true', help='Rebuild every zip even when its manifest is unchanged')
+    parser.add_argument('--hash', action='store_true', help='Also compare file contents by SHA-256, not only size and mtime')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of game archives built at once')
+    parser.add_argument('--level', type=int, default=6, choices=range(0, 10), metavar='0-9', help='Deflate level for table and config files')
+    parser.add_argument('--format', choices=['zip', 'store'], default='zip', help='One zip per game, or a deduplicated content-addressed store')
+    parser.add_argument('--restore', metavar='GAME', help='Rebuild the files of one game from the store and exit')
+    parser.add_argument('--restore-to', metavar='DIR', help='Restore under this directory instead of the original paths')
+    args = parser.parse_args()
+
+    if args.restore:
+        restore_game(args.restore, args.restore_to)
+        return
+
     conn = connect_db(db_path)
     games_data = fetch_games_data(conn)
     conn.close()
 
+    summary = {"Added": 0, "Rebuilt": 0, "Skipped": 0, "Failed": 0}
+    worker_stats = defaultdict(lambda: [0, 0.0])
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(args.workers, 1), thread_name_prefix='backup')
+    # Jobs grouped by the archive or manifest they write
+    jobs = defaultdict(list)
+    known_files = load_known_files() if args.format == 'store' else None
+
     for game_file, rom_file, emuname, dir_games in games_data:
         if not game_file and not rom_file:
             continue
@@ -107,13 +350,37 @@ def main():
 
         # Create directory structure for the backup file
         game_file_name = os.path.splitext(os.path.basename(game_file))[0]
+        if args.format == 'store':
+            jobs[os.path.normcase(game_manifest_path(game_file_name))].append(
+                (game_file, build_store_backup, (game_file_name, files_to_backup, relevant_directories, known_files, args.force, args.level)))
+            continue
+
         backup_zip_path = os.path.join(backup_folder, f"{game_file_name}_backup.zip")
+        manifest_path = os.path.join(backup_folder, f"{game_file_name}_backup.manifest.json")
         os.makedirs(os.path.dirname(backup_zip_path), exist_ok=True)
-        
-        if debug: print(f"Creating backup zip at: {backup_zip_path}")
-        with zipfile.ZipFile(backup_zip_path, 'w') as backup_zip:
-            backup_files(files_to_backup, backup_zip, relevant_directories)
-        if debug: print(f"Backup for {game_file_name} completed")
+        jobs[os.path.normcase(backup_zip_path)].append(
+            (game_file, backup_game, (backup_zip_path, manifest_path, files_to_backup, relevant_directories, args.hash, args.force, args.level)))
+
+    with executor:
+        futures = [executor.submit(run_in_order, group) for group in jobs.values()]
+        for future in futures:
+            for name, result, error in future.result():
+                if error is not None:
+                    print(f"Error backing up {name}: {error}")
+                    summary["Failed"] += 1
+                    continue
+                status, worker, total_bytes, seconds = result
+                summary[status] += 1
+                if status != "Skipped":
+                    worker_stats[worker][0] += total_bytes
+                    worker_stats[worker][1] += seconds
+    elapsed = time.perf_counter() - start
+
+    for worker, (total_bytes, seconds) in sorted(worker_stats.items()):
+        print(f"{worker}: {total_bytes / (1024 * 1024):.1f} MB in {seconds:.1f}s ({total_bytes / (1024 * 1024) / max(seconds, 1e-9):.1f} MB/s)")
+    total_bytes = sum(stats[0] for stats in worker_stats.values())
+    print(f"Total: {total_bytes / (1024 * 1024):.1f} MB in {elapsed:.1f}s ({total_bytes / (1024 * 1024) / max(elapsed, 1e-9):.1f} MB/s)")
+    print(f"Backups added: {summary['Added']}, rebuilt: {summary['Rebuilt']}, skipped: {summary['Skipped']}, failed: {summary['Failed']}")
 
 if __name__ == "__main__":
     main()
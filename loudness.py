@@ -0,0 +1,96 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+import subprocess
+
+# Shared by reencodemovies.py and recursive_normalize.py: two-pass EBU R128 loudness normalization.
+# The first pass measures a file with loudnorm's JSON output and caches the statistics by content
+# fingerprint, so re-runs only analyse new files. The encode pass feeds them back in linear mode.
+
+LOUDNORM_TARGET = 'I=-23:LRA=7:TP=-2'
+TARGET_I = -23.0
+TARGET_TP = -2.0
+MEASURED_KEYS = ['input_i', 'input_tp', 'input_lra', 'input_thresh', 'target_offset']
+
+# Function to fingerprint a file by size and its first and last megabyte, which is cheap even for large videos
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+# On-disk SQLite cache of loudnorm measurements, safe to share between transcode worker threads
+class LoudnessCache:
+    def __init__(self, cache_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS loudness (fingerprint TEXT PRIMARY KEY, stats TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, fingerprint):
+        with self.lock:
+            row = self.conn.execute("SELECT stats FROM loudness WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, fingerprint, stats):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO loudness (fingerprint, stats) VALUES (?, ?)", (fingerprint, json.dumps(stats)))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def parse_loudnorm_json(output):
+    start = output.rfind('{')
+    end = output.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        stats = json.loads(output[start:end + 1])
+    except ValueError:
+        return None
+    if not all(key in stats for key in MEASURED_KEYS):
+        return None
+    return {key: stats[key] for key in MEASURED_KEYS}
+
+# Function to run (or look up) the measurement pass. Returns None when the measurement fails, which
+# includes files without an audio stream; callers tell the two apart from the probed audio codec.
+def measure_loudness(ffmpeg_path, path, cache=None):
+    fingerprint = file_fingerprint(path) if cache is not None else None
+    if cache is not None:
+        stats = cache.get(fingerprint)
+        if stats is not None:
+            return stats
+
+    command = [
+        ffmpeg_path, '-hide_banner', '-nostats',
+        '-i', path,
+        '-vn', '-sn', '-dn',
+        '-af', f'loudnorm={LOUDNORM_TARGET}:print_format=json',
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    stats = parse_loudnorm_json(result.stderr) if result.returncode == 0 else None
+
+    if stats is not None and cache is not None:
+        cache.put(fingerprint, stats)
+    return stats
+
+# Function to build the encode pass filter, falling back to single-pass loudnorm without a measurement
+def loudnorm_filter(stats):
+    if stats is None:
+        return f'loudnorm={LOUDNORM_TARGET}'
+    return (f"loudnorm={LOUDNORM_TARGET}"
+            f":measured_I={stats['input_i']}:measured_TP={stats['input_tp']}"
+            f":measured_LRA={stats['input_lra']}:measured_thresh={stats['input_thresh']}"
+            f":offset={stats['target_offset']}:linear=true")
+
+# Function to check whether measured audio already meets the target integrated loudness and true peak
+def within_target(stats, tolerance=1.0):
+    return abs(float(stats['input_i']) - TARGET_I) <= tolerance and float(stats['input_tp']) <= TARGET_TP + tolerance
@@ -0,0 +1,95 @@
+import os
+import json
+import sqlite3
+import threading
+import subprocess
+from collections import namedtuple
+
+# Shared by reencodemovies.py and recursive_normalize.py: reads stream details with ffprobe's JSON
+# output instead of scraping ffmpeg's banner, and caches them by path, size and mtime so repeat
+# runs never launch a probe for unchanged files.
+
+MediaInfo = namedtuple('MediaInfo', [
+    'video_codec', 'width', 'height', 'bitrate', 'duration',
+    'audio_codec', 'audio_channels', 'channel_layout', 'sample_rate',
+])
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Function to turn ffprobe's -show_streams -show_format JSON into a MediaInfo, using the first video and audio streams
+def parse_probe_json(data):
+    streams = data.get('streams', [])
+    media_format = data.get('format', {})
+    # Attached cover art shows up as a video stream, so skip it when looking for the real video
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'
+                  and not stream.get('disposition', {}).get('attached_pic')), {})
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+    return MediaInfo(
+        video_codec=video.get('codec_name'),
+        width=to_int(video.get('width')),
+        height=to_int(video.get('height')),
+        bitrate=to_int(media_format.get('bit_rate')),
+        duration=to_float(media_format.get('duration')),
+        audio_codec=audio.get('codec_name'),
+        audio_channels=to_int(audio.get('channels')),
+        channel_layout=audio.get('channel_layout'),
+        sample_rate=to_int(audio.get('sample_rate')),
+    )
+
+# On-disk SQLite cache of probe results keyed by path, safe to share between transcode worker threads
+class ProbeCache:
+    def __init__(self, cache_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, info TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.conn.execute("SELECT info FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?", (path, size, mtime_ns)).fetchone()
+        return MediaInfo(**json.loads(row[0])) if row else None
+
+    def put(self, path, size, mtime_ns, info):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO probes (path, size, mtime_ns, info) VALUES (?, ?, ?, ?)", (path, size, mtime_ns, json.dumps(info._asdict())))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# Function to probe a media file, returning None when ffprobe can't read it
+def probe_media(ffprobe_path, path, cache=None):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    if cache is not None:
+        info = cache.get(path, stat.st_size, stat.st_mtime_ns)
+        if info is not None:
+            return info
+
+    command = [
+        ffprobe_path, '-v', 'error',
+        '-show_streams', '-show_format',
+        '-of', 'json',
+        path
+    ]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors='replace')
+    if result.returncode != 0:
+        return None
+    try:
+        info = parse_probe_json(json.loads(result.stdout))
+    except ValueError:
+        return None
+
+    if cache is not None:
+        cache.put(path, stat.st_size, stat.st_mtime_ns, info)
+    return info
@@ -0,0 +1,93 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# Shared by lists.py, scanclose.py and backuptables.py: read-only access to PinUP Popper's
+# PUPDatabase.db. Connections are opened as mode=ro URIs so a running Popper never waits on our
+# locks, kept in a bounded pool shared by every thread so statements stay prepared between calls
+# (servers that start a thread per request still reuse them), and tuned for reads.
+# Table columns are looked up once and only re-read when the schema version changes.
+
+mmap_size = 256 * 1024 * 1024
+cache_size_kib = 64 * 1024
+cached_statements = 256
+pool_size = 8
+
+def read_only_uri(db_path):
+    return 'file:' + pathname2url(os.path.abspath(db_path)) + '?mode=ro'
+
+class ReadOnlyPool:
+    def __init__(self, db_path, size=pool_size):
+        self.db_path = db_path
+        # Idle connections, most recently used first. Each free slot starts as None and is only
+        # opened when it is first needed; a caller waits when all of them are in use.
+        self.idle = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self.idle.put(None)
+        self.lock = threading.Lock()
+        self.schema_version = None
+        self.schema = {}
+
+    # Function to open a new tuned read-only connection, for callers that need one of their own
+    def connect(self, check_same_thread=True):
+        conn = sqlite3.connect(read_only_uri(self.db_path), uri=True, check_same_thread=check_same_thread,
+                               cached_statements=cached_statements)
+        conn.execute(f"PRAGMA mmap_size = {mmap_size}")
+        conn.execute(f"PRAGMA cache_size = -{cache_size_kib}")
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    # Function to borrow a pooled connection for the length of a with block, opening it on first use
+    @contextmanager
+    def connection(self):
+        conn = self.idle.get()
+        try:
+            if conn is None:
+                conn = self.connect(check_same_thread=False)
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def query(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    # Function to return the first column of every row
+    def query_values(self, sql, params=()):
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(sql, params)]
+
+    # Function to return a table's column names, cached until the schema changes
+    def columns(self, table):
+        with self.connection() as conn:
+            schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        with self.lock:
+            if schema_version != self.schema_version:
+                self.schema = {}
+                self.schema_version = schema_version
+            columns = self.schema.get(table.lower())
+        if columns is None:
+            with self.connection() as conn:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            with self.lock:
+                self.schema[table.lower()] = columns
+        return columns
+
+    # Function to pick a column by name, falling back to its position for databases that name it differently
+    def column(self, table, preferred, fallback_index):
+        columns = self.columns(table)
+        return preferred if preferred in columns else columns[fallback_index]
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Function to return the shared pool for a database, so every caller in a process reuses its connections
+def get_pool(db_path):
+    key = os.path.normcase(os.path.abspath(db_path))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ReadOnlyPool(db_path)
+        return pools[key]
@@ -0,0 +1,170 @@
+import os
+import json
+import sqlite3
+import datetime
+import threading
+from loudness import file_fingerprint
+
+# Shared by reencodemovies.py and recursive_normalize.py: a per-file record of what each run did,
+# replacing the single last_run.txt timestamp. Each row holds the input fingerprint, the action and
+# encoder settings used, the original's backup path and the resulting file's fingerprint, size and
+# mtime. Rows marked 'started' belong to a run that was interrupted and are resumed by recover().
+
+class ProcessManifest:
+    def __init__(self, directory, manifest_name='normalize_manifest.db'):
+        self.directory = directory
+        self.lock = threading.Lock()
+        manifest_path = os.path.join(directory, manifest_name)
+        # A brand new manifest may still need the files of a last_run.txt run carried over
+        self.created = not os.path.exists(manifest_path)
+        self.conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            action TEXT,
+            settings TEXT,
+            input_fingerprint TEXT,
+            output_fingerprint TEXT,
+            backup_path TEXT,
+            size INTEGER,
+            mtime_ns INTEGER
+        )
+        """)
+        self.conn.commit()
+
+    def key(self, path):
+        return os.path.relpath(path, self.directory)
+
+    def full_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def execute(self, query, params=()):
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+            self.conn.commit()
+        return rows
+
+    def record(self, path, status, action=None, settings=None, input_fingerprint=None, backup_path=None):
+        # The fingerprint, size and mtime describe the file as it now sits at path
+        output_fingerprint = size = mtime_ns = None
+        if os.path.exists(path):
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            output_fingerprint = file_fingerprint(path)
+        self.execute("INSERT OR REPLACE INTO files (path, status, action, settings, input_fingerprint, output_fingerprint, backup_path, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (self.key(path), status, action, json.dumps(settings) if settings is not None else None, input_fingerprint, output_fingerprint,
+                      self.key(backup_path) if backup_path else None, size, mtime_ns))
+
+    # Function to decide whether a file still needs work: anything this manifest produced or chose to
+    # leave alone is skipped for as long as its contents stay the same
+    def should_process(self, path):
+        rows = self.execute("SELECT status, output_fingerprint, size, mtime_ns FROM files WHERE path = ?", (self.key(path),))
+        if not rows or rows[0][0] not in ('done', 'skipped', 'finalized'):
+            return True
+        status, output_fingerprint, size, mtime_ns = rows[0]
+        stat = os.stat(path)
+        if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+            return False
+        return file_fingerprint(path) != output_fingerprint
+
+    # Function to record a job before its file is moved to backup_path. An original already sitting there
+    # belongs to a run that was never finalized, so the job fails rather than overwrite it.
+    def start(self, path, input_fingerprint, backup_path, action, settings):
+        if os.path.exists(backup_path):
+            raise FileExistsError(f"{backup_path} already holds an original from an earlier run; undo or finalize that run first")
+        self.execute("INSERT OR REPLACE INTO files (path, status, action, settings, input_fingerprint, backup_path) VALUES (?, 'started', ?, ?, ?, ?)",
+                     (self.key(path), action, json.dumps(settings), input_fingerprint, self.key(backup_path)))
+
+    def finish(self, path):
+        rows = self.execute("SELECT action, settings, input_fingerprint, backup_path FROM files WHERE path = ?", (self.key(path),))
+        action, settings, input_fingerprint, backup_path = rows[0]
+        self.record(path, 'done', action, json.loads(settings), input_fingerprint, self.full_path(backup_path))
+
+    def skip(self, path, input_fingerprint, action='skip'):
+        self.record(path, 'skipped', action, input_fingerprint=input_fingerprint)
+
+    def forget(self, path):
+        self.execute("DELETE FROM files WHERE path = ?", (self.key(path),))
+
+    # Function to return (path, backup_path) for every file whose original is still kept in an original/ folder
+    def backed_up(self):
+        return [(self.full_path(path), self.full_path(backup_path))
+                for path, backup_path in self.execute("SELECT path, backup_path FROM files WHERE status = 'done' AND backup_path IS NOT NULL ORDER BY path")]
+
+    def mark_finalized(self, path):
+        self.execute("UPDATE files SET status = 'finalized', backup_path = NULL WHERE path = ?", (self.key(path),))
+
+    # Function to resume after an interrupted run. A job that got as far as renaming its output into place
+    # is recorded as done; otherwise the partial output is removed and the original moved back so it is
+    # queued again.
+    def recover(self, output_name, log=print):
+        for path, backup_path in self.execute("SELECT path, backup_path FROM files WHERE status = 'started'"):
+            full_path = self.full_path(path)
+            backup_path = self.full_path(backup_path)
+            partial_path = output_name(full_path)
+            if os.path.exists(full_path) and os.path.exists(backup_path):
+                log(f"Recovered completed file: {full_path}")
+                self.finish(full_path)
+                continue
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            if os.path.exists(backup_path) and not os.path.exists(full_path):
+                os.replace(backup_path, full_path)
+            log(f"Recovered interrupted file: {full_path}")
+            self.forget(full_path)
+
+    # Function to carry over a run from before the manifest, which only left last_run.txt behind. As that
+    # run did, files not modified since its timestamp count as processed, paired with their original in
+    # original/ when it is still there so undo and finalize treat them like any other backed-up file.
+    def import_last_run(self, last_run_file, extensions, log=print):
+        if not self.created or not os.path.exists(last_run_file):
+            return
+        with open(last_run_file, 'r') as file:
+            last_run_date = datetime.datetime.fromisoformat(file.read().strip())
+        imported = 0
+        for current_directory, directories, files in os.walk(self.directory):
+            directories[:] = [entry for entry in directories if entry != 'original']
+            for file in files:
+                path = os.path.join(current_directory, file)
+                if not file.endswith(extensions) or file.startswith('normalized_'):
+                    continue
+                if datetime.datetime.fromtimestamp(os.path.getmtime(path)) > last_run_date:
+                    continue
+                backup_path = os.path.join(current_directory, 'original', file)
+                if os.path.exists(backup_path):
+                    self.record(path, 'done', 'last_run', backup_path=backup_path)
+                else:
+                    self.record(path, 'finalized', 'last_run')
+                imported += 1
+        log(f"Imported {imported} files processed before {last_run_date.isoformat()} from {last_run_file}")
+
+    def close(self):
+        self.conn.close()
+
+# Function to undo a run from the manifest alone: restore every backed-up original and forget its row
+def undo_from_manifest(manifest, log=print):
+    for path, backup_path in manifest.backed_up():
+        if os.path.exists(backup_path):
+            if os.path.exists(path):
+                log(f"Removing normalized file: {path}")
+                os.remove(path)
+            os.replace(backup_path, path)
+            log(f"Restored original file: {path}")
+            remove_empty_dir(os.path.dirname(backup_path), log)
+        manifest.forget(path)
+
+# Function to finalize a run from the manifest alone: delete the backed-up originals but keep the rows
+# so the finished files are still recognised and skipped next time
+def finalize_from_manifest(manifest, log=print):
+    for path, backup_path in manifest.backed_up():
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+            log(f"Removed original file: {backup_path}")
+            remove_empty_dir(os.path.dirname(backup_path), log)
+        manifest.mark_finalized(path)
+
+def remove_empty_dir(directory, log=print):
+    if os.path.isdir(directory) and not os.listdir(directory):
+        os.rmdir(directory)
+        log(f"Removed empty original directory: {directory}")
@@ -1,73 +1,253 @@
 import os
-import subprocess
 import shutil
-import datetime
 import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from transcode_jobs import run_jobs, run_ffmpeg, threads_per_job, BatchProgress, MetricsLog
+from loudness import LoudnessCache, measure_loudness, loudnorm_filter, within_target, file_fingerprint
+from media_probe import ProbeCache, probe_media
+from process_manifest import ProcessManifest, undo_from_manifest, finalize_from_manifest
 
 # Specify the full path to the FFmpeg executable
 ffmpeg_path = r'C:\vPinball\PinUPSystem\Recordings\ffmpeg'
+ffprobe_path = r'C:\vPinball\PinUPSystem\Recordings\ffprobe'
 
-def normalize_audio(directory):
-    last_run_file = os.path.join(directory, 'last_run.txt')
-    last_run_date = datetime.datetime.min
+# Function to pick the cheapest action that gets a file to HEVC video and target loudness:
+# leave it alone, remux with only the audio re-encoded, or re-encode everything.
+# A file with no audio stream has nothing to normalize, but audio whose measurement failed is not
+# known to be in target, so it still gets the single-pass loudnorm fallback.
+def decide_action(video_codec, has_audio, loudness_stats, tolerance=1.0):
+    audio_ok = not has_audio or (loudness_stats is not None and within_target(loudness_stats, tolerance))
+    if video_codec == 'hevc':
+        return 'skip' if audio_ok else 'remux'
+    return 'encode'
 
-    if os.path.exists(last_run_file):
-        with open(last_run_file, 'r') as file:
-            last_run_date = datetime.datetime.fromisoformat(file.read().strip())
+def normalized_name(full_path):
+    return os.path.join(os.path.dirname(full_path), f'normalized_{os.path.basename(full_path)}')
 
-    def process_directory(current_directory):
+# Encoder settings for the audio mode, keeping each file in its own format
+audio_codecs = {
+    '.mp3': ['-c:a', 'libmp3lame', '-q:a', '2'],
+    '.ogg': ['-c:a', 'libvorbis', '-q:a', '5'],
+    '.wav': ['-c:a', 'pcm_s16le'],
+}
+
+# Audio mode workers each keep their own manifest and loudness cache connections; SQLite handles
+# the locking between processes
+def init_audio_worker(directory, worker_ffmpeg_path):
+    global ffmpeg_path, worker_manifest, worker_loudness_cache
+    ffmpeg_path = worker_ffmpeg_path
+    worker_manifest = ProcessManifest(directory)
+    worker_loudness_cache = LoudnessCache(os.path.join(directory, 'loudness_cache.db'))
+
+# Function to normalize one audio file in place with the same backup and manifest steps as the videos.
+# Returns the action taken with the original and new sizes.
+def normalize_audio_file(full_path):
+    file = os.path.basename(full_path)
+    original_dir = os.path.join(os.path.dirname(full_path), 'original')
+    backup_file = os.path.join(original_dir, file)
+    normalized_file = normalized_name(full_path)
+
+    input_fingerprint = file_fingerprint(full_path)
+    loudness_stats = measure_loudness(ffmpeg_path, full_path, worker_loudness_cache)
+    if loudness_stats is not None and within_target(loudness_stats):
+        worker_manifest.skip(full_path, input_fingerprint)
+        return 'skip', None, None
+    if loudness_stats is None:
+        print(f"Loudness measurement failed for {file}, using single-pass loudnorm")
+
+    os.makedirs(original_dir, exist_ok=True)
+    command = [
+        ffmpeg_path, '-y',
+        '-i', backup_file,
+        '-threads', '1',
+        '-vn',
+        '-af', loudnorm_filter(loudness_stats), '-ar', '44100',
+    ] + audio_codecs[os.path.splitext(file)[1].lower()] + [normalized_file]
+    settings = [arg for arg in command[1:] if arg not in (backup_file, normalized_file)]
+    worker_manifest.start(full_path, input_fingerprint, backup_file, 'audio', settings)
+    shutil.move(full_path, backup_file)
+    try:
+        run_ffmpeg(command)
+    except Exception:
+        if os.path.exists(normalized_file):
+            os.remove(normalized_file)
+        shutil.move(backup_file, full_path)
+        worker_manifest.forget(full_path)
+        raise
+    os.rename(normalized_file, full_path)
+    worker_manifest.finish(full_path)
+    return 'audio', os.path.getsize(backup_file), os.path.getsize(full_path)
+
+# Function to run a batch of audio files in one worker so process hand-off isn't paid per tiny file
+def normalize_audio_batch(paths):
+    results = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            action, input_bytes, output_bytes = normalize_audio_file(path)
+            error = None
+        except Exception as e:
+            action, input_bytes, output_bytes = 'failed', None, None
+            details = getattr(e, 'stderr', None)
+            error = f"{e}" + (f"\n{details}" if details else "")
+        results.append((path, action, input_bytes, output_bytes, time.perf_counter() - start, error))
+    return results
+
+def normalize_audio(directory, mode, jobs=1, batch_size=32):
+    # Check the mode before the manifest is opened, so a typo doesn't leave a database behind
+    if mode not in ('process', 'audio', 'undo', 'finalize'):
+        print("Invalid command. Usage: recursive_normalize.py [process|audio|undo|finalize]")
+        return
+    manifest = ProcessManifest(directory)
+    # Runs from before the manifest only left last_run.txt behind
+    last_run_file = os.path.join(directory, 'last_run.txt')
+    manifest.import_last_run(last_run_file, ('.mp4',))
+
+    # Collect the work list first so the encodes can run several at a time
+    def collect_files(current_directory, work, extensions=('.mp4',)):
         print(f"Checking directory: {current_directory}")  # Debug: show current directory being processed
         for entry in os.listdir(current_directory):
             path = os.path.join(current_directory, entry)
             if os.path.isdir(path):
                 if entry != 'original':
-                    process_directory(path)
-            elif path.endswith('.mp4'):
-                file_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
-                if file_mtime > last_run_date:
-                    print(f"Processing file: {entry}")  # Debug: processing this file
-                    process_file(path, current_directory)
+                    collect_files(path, work, extensions)
+            elif path.lower().endswith(extensions) and not entry.startswith('normalized_'):
+                if manifest.should_process(path):
+                    print(f"Queued file: {entry}")  # Debug: processing this file
+                    work.append((path, current_directory))
                 else:
-                    print(f"Skipping file: {entry}, not modified since last run.")  # Debug: file skipped
+                    print(f"Skipping file: {entry}, already processed.")  # Debug: file skipped
+        return work
+
+    loudness_cache = None
+    probe_cache = None
+    progress = None
+    metrics = MetricsLog(os.path.join(directory, 'transcode_metrics.jsonl'))
+
+    def process_directory(current_directory):
+        nonlocal loudness_cache, probe_cache, progress
+        loudness_cache = LoudnessCache(os.path.join(directory, 'loudness_cache.db'))
+        probe_cache = ProbeCache(os.path.join(directory, 'probe_cache.db'))
+        manifest.recover(normalized_name)
+        try:
+            work = collect_files(current_directory, [])
+            progress = BatchProgress(len(work))
+            run_jobs(work, process_file, jobs=jobs)
+            metrics.summary()
+        finally:
+            loudness_cache.close()
+            probe_cache.close()
 
     def process_file(full_path, current_directory):
         original_dir = os.path.join(current_directory, 'original')
-        if not os.path.exists(original_dir):
-            os.makedirs(original_dir)
+        os.makedirs(original_dir, exist_ok=True)
 
         file = os.path.basename(full_path)
         backup_file = os.path.join(original_dir, file)
-        normalized_file = os.path.join(current_directory, f'normalized_{file}')
-        
+        normalized_file = normalized_name(full_path)
+
+        input_fingerprint = file_fingerprint(full_path)
+        loudness_stats = measure_loudness(ffmpeg_path, full_path, loudness_cache)
+        media_info = probe_media(ffprobe_path, full_path, probe_cache)
+        has_audio = media_info is None or media_info.audio_codec is not None
+        action = decide_action(media_info.video_codec if media_info else None, has_audio, loudness_stats)
+        if has_audio and loudness_stats is None:
+            print(f"Loudness measurement failed for {file}, using single-pass loudnorm")
+        if action == 'skip':
+            print(f"Skipping file: {file}, already HEVC and within loudness tolerance.")  # Debug: file skipped
+            manifest.skip(full_path, input_fingerprint)
+            progress.skip()
+            return
+
+        threads = threads_per_job(jobs)
+        audio_filter = loudnorm_filter(loudness_stats)
+        if action == 'remux':
+            # Video is already HEVC, so only the audio is re-encoded
+            print(f"Remuxing audio only for {file}")  # Debug: audio-only path
+            command = [
+                ffmpeg_path, '-y',
+                '-i', backup_file,
+                '-c:v', 'copy',
+                '-af', audio_filter, '-ar', '44100', '-c:a', 'aac', '-b:a', '128k',
+                normalized_file
+            ]
+        else:
+            command = [
+                ffmpeg_path, '-y',
+                '-i', backup_file,
+                '-threads', str(threads),
+                '-c:v', 'libx265', '-crf', '28', '-preset', 'fast', '-x265-params', f'pools={threads}',
+                '-af', audio_filter, '-ar', '44100', '-c:a', 'aac', '-b:a', '128k',
+                normalized_file
+            ]
+        # Record the job before touching the file so an interrupted run can be resumed
+        settings = [arg for arg in command[1:] if arg not in (backup_file, normalized_file)]
+        manifest.start(full_path, input_fingerprint, backup_file, action, settings)
         shutil.move(full_path, backup_file)
-        command = [
-            ffmpeg_path,
-            '-i', backup_file,
-            '-c:v', 'libx265', '-crf', '28', '-preset', 'fast',
-            '-af', 'loudnorm=I=-23:LRA=7:TP=-2', '-ar', '44100', '-c:a', 'aac', '-b:a', '128k',
-            normalized_file
-        ]
-        subprocess.run(command, check=True)
+        duration = media_info.duration if media_info else None
+        job_progress = progress.start(file, duration)
+        try:
+            run_ffmpeg(command, progress=job_progress.update)
+        except Exception:
+            # Put the original back so a failed job leaves the library as it was
+            if os.path.exists(normalized_file):
+                os.remove(normalized_file)
+            shutil.move(backup_file, full_path)
+            manifest.forget(full_path)
+            raise
+        finally:
+            progress.finish(job_progress)
         os.rename(normalized_file, full_path)
+        manifest.finish(full_path)
+        metrics.write(file, action, os.path.getsize(backup_file), os.path.getsize(full_path), duration, job_progress.elapsed())
         print(f"Completed processing on {file}")  # Debug: completed processing
 
-    if sys.argv[1] == 'process':
-        process_directory(directory)
-        with open(last_run_file, 'w') as file:
-            file.write(datetime.datetime.now().isoformat())
-        print("Updated last run time.")
+    # Audio files are small and numerous, so they go to a process pool in batches
+    def process_audio(current_directory):
+        manifest.recover(normalized_name)
+        work = [path for path, _ in collect_files(current_directory, [], tuple(audio_codecs))]
+        batches = [work[i:i + batch_size] for i in range(0, len(work), batch_size)]
+        counts = {'audio': 0, 'skip': 0, 'failed': 0}
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max(jobs, 1), initializer=init_audio_worker, initargs=(directory, ffmpeg_path)) as executor:
+            futures = [executor.submit(normalize_audio_batch, batch) for batch in batches]
+            for number, future in enumerate(as_completed(futures), 1):
+                for path, action, input_bytes, output_bytes, seconds, error in future.result():
+                    counts[action] += 1
+                    if error is not None:
+                        print(f"Error processing file {path}: {error}")
+                    elif action == 'audio':
+                        metrics.write(os.path.basename(path), 'audio', input_bytes, output_bytes, None, seconds)
+                print(f"Batch {number}/{len(batches)} done")  # Debug: batch progress
+        print(f"Processed {len(work)} audio files in {time.perf_counter() - start:.1f}s: "
+              f"{counts['audio']} normalized, {counts['skip']} already within tolerance, {counts['failed']} failed")
+        metrics.summary()
 
-    elif sys.argv[1] == 'undo':
-        undo_changes(directory)
-        if os.path.exists(last_run_file):
-            os.remove(last_run_file)
-            print("Removed last run tracking file.")
+    # Originals of those runs that the manifest doesn't know about are found by walking the tree
+    try:
+        if mode == 'process':
+            process_directory(directory)
 
-    elif sys.argv[1] == 'finalize':
-        finalize_changes(directory)
+        elif mode == 'audio':
+            process_audio(directory)
 
-    else:
-        print("Invalid command. Usage: recursive_normalize.py [process|undo|finalize]")
+        elif mode == 'undo':
+            undo_from_manifest(manifest)
+            if os.path.exists(last_run_file):
+                undo_changes(directory)
+                os.remove(last_run_file)
+                print("Removed last run tracking file.")
+
+        elif mode == 'finalize':
+            finalize_from_manifest(manifest)
+            if os.path.exists(last_run_file):
+                finalize_changes(directory)
+                os.remove(last_run_file)
+                print("Removed last run tracking file.")
+    finally:
+        manifest.close()
 
 def undo_changes(current_directory):
     original_dir = os.path.join(current_directory, 'original')
@@ -108,6 +288,12 @@ def finalize_changes(current_directory):
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: recursive_normalize.py [process|undo|finalize]")
+        print("Usage: recursive_normalize.py [process|audio|undo|finalize] [--jobs N]")
     else:
-        normalize_audio('.')
+        parser = argparse.ArgumentParser(description='Normalize audio and re-encode mp4 files to H.265 in place, keeping the originals.')
+        parser.add_argument('mode', help='process, audio (mp3/ogg/wav), undo or finalize')
+        parser.add_argument('--jobs', type=int, help='Number of ffmpeg encodes run at once (default 1, or one per core in audio mode)')
+        parser.add_argument('--batch-size', type=int, default=32, help='Audio files handed to a worker process at a time')
+        args = parser.parse_args()
+        jobs = args.jobs or ((os.cpu_count() or 1) if args.mode == 'audio' else 1)
+        normalize_audio('.', args.mode, jobs=jobs, batch_size=args.batch_size)
@@ -1,9 +1,12 @@
 import os
-import subprocess
 import shutil
-import datetime
 import sys
 import logging
+import argparse
+from transcode_jobs import run_jobs, run_ffmpeg, threads_per_job, BatchProgress, MetricsLog, encode_segmented
+from loudness import LoudnessCache, measure_loudness, loudnorm_filter, file_fingerprint
+from media_probe import ProbeCache, probe_media
+from process_manifest import ProcessManifest, undo_from_manifest, finalize_from_manifest
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,
@@ -15,69 +18,85 @@ logging.basicConfig(level=logging.DEBUG,
 
 # Specify the full path to the FFmpeg executable
 ffmpeg_path = r'C:\vPinball\PinUPSystem\Recordings\ffmpeg.exe'
+ffprobe_path = r'C:\vPinball\PinUPSystem\Recordings\ffprobe.exe'
 
-def normalize_audio(directory):
-    last_run_file = os.path.join(directory, 'last_run.txt')
-    last_run_date = datetime.datetime.min
+def normalized_name(full_path):
+    return os.path.join(os.path.dirname(full_path), f'normalized_{os.path.basename(full_path)}')
 
-    if os.path.exists(last_run_file):
-        with open(last_run_file, 'r') as file:
-            last_run_date = datetime.datetime.fromisoformat(file.read().strip())
+def normalize_audio(directory, mode, jobs=1, segment_seconds=0, segment_jobs=4):
+    # Check the mode before the manifest is opened, so a typo doesn't leave a database behind
+    if mode not in ('process', 'processtv', 'undo', 'finalize'):
+        logging.error("Invalid command. Usage: recursive_normalize.py [process|processtv|undo|finalize]")
+        return
+    manifest = ProcessManifest(directory)
+    # Runs from before the manifest only left last_run.txt behind
+    last_run_file = os.path.join(directory, 'last_run.txt')
+    manifest.import_last_run(last_run_file, ('.mp4', '.mkv'), log=logging.info)
 
-    def process_directory(current_directory):
+    # Collect the work list first so the encodes can run several at a time
+    def collect_files(current_directory, work, file_mode):
         logging.debug(f"Checking directory: {current_directory}")
         for entry in os.listdir(current_directory):
             path = os.path.join(current_directory, entry)
             if os.path.isdir(path):
                 if entry != 'original':
-                    process_directory(path)
-            elif path.endswith(('.mp4', '.mkv')):
-                file_mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path))
-                if file_mtime > last_run_date:
-                    logging.debug(f"Processing file: {entry}")
-                    process_file(path, current_directory, 'normalize')
+                    collect_files(path, work, file_mode)
+            elif path.endswith(('.mp4', '.mkv')) and not entry.startswith('normalized_'):
+                if manifest.should_process(path):
+                    logging.debug(f"Queued file: {entry}")
+                    work.append((path, current_directory, file_mode))
                 else:
-                    logging.debug(f"Skipping file: {entry}, not modified since last run.")
+                    logging.debug(f"Skipping file: {entry}, already processed.")
+        return work
+
+    loudness_cache = None
+    probe_cache = None
+    progress = None
+    metrics = MetricsLog(os.path.join(directory, 'transcode_metrics.jsonl'))
+
+    def process_directory(current_directory, file_mode):
+        nonlocal loudness_cache, probe_cache, progress
+        loudness_cache = LoudnessCache(os.path.join(directory, 'loudness_cache.db'))
+        probe_cache = ProbeCache(os.path.join(directory, 'probe_cache.db'))
+        manifest.recover(normalized_name, log=logging.info)
+        try:
+            work = collect_files(current_directory, [], file_mode)
+            progress = BatchProgress(len(work), log=logging.info)
+            run_jobs(work, process_file, jobs=jobs, log=logging.info)
+            metrics.summary(log=logging.info)
+        finally:
+            loudness_cache.close()
+            probe_cache.close()
 
     def process_file(full_path, current_directory, mode):
         original_dir = os.path.join(current_directory, 'original')
-        if not os.path.exists(original_dir):
-            os.makedirs(original_dir)
+        os.makedirs(original_dir, exist_ok=True)
 
         file = os.path.basename(full_path)
         backup_file = os.path.join(original_dir, file)
-        normalized_file = os.path.join(current_directory, f'normalized_{file}')
-        
-        shutil.move(full_path, backup_file)
+        normalized_file = normalized_name(full_path)
+        input_fingerprint = file_fingerprint(full_path)
+
+        # Check the original codec and resolution before the file is moved so the probe cache still matches it
+        media_info = probe_media(ffprobe_path, full_path, probe_cache)
+        original_codec = media_info.video_codec if media_info else None
+        original_resolution = (media_info.width, media_info.height) if media_info and media_info.width and media_info.height else None
 
-        # Check the original codec and resolution
-        command = [
-            ffmpeg_path,
-            '-i', backup_file,
-            '-hide_banner'
-        ]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        lines = result.stderr.split('\n')
-
-        original_codec = None
-        original_resolution = None
-        for line in lines:
-            if 'Stream #0:0' in line and 'Video' in line:
-                original_codec = line.split()[3]
-                if 'x' in line:
-                    resolution_part = line.split()[5]
-                    width, height = map(int, resolution_part.split('x'))
-                    original_resolution = (width, height)
+        threads = str(threads_per_job(jobs))
+        segmented = False
+        audio_filter = loudnorm_filter(measure_loudness(ffmpeg_path, full_path, loudness_cache))
 
         if mode == 'normalize':
             if original_codec == 'hevc':
                 # Only normalize audio
+                preset = 'normalize-copy'
                 command = [
-                    ffmpeg_path,
+                    ffmpeg_path, '-y',
                     '-hwaccel', 'cuda',
                     '-i', backup_file,
+                    '-threads', threads,
                     '-c:v', 'copy',
-                    '-af', 'loudnorm=I=-23:LRA=7:TP=-2',
+                    '-af', audio_filter,
                     '-ar', '44100',
                     '-c:a', 'aac',
                     '-b:a', '128k',
@@ -86,16 +105,18 @@ def normalize_audio(directory):
                 ]
             else:
                 # Re-encode video to H.265 and normalize audio
+                preset = 'normalize-hevc'
                 command = [
-                    ffmpeg_path,
+                    ffmpeg_path, '-y',
                     '-hwaccel', 'cuda',
                     '-i', backup_file,
+                    '-threads', threads,
                     '-c:v', 'hevc_nvenc',
                     '-b:v', '2M',  # Lower target average bitrate
                     '-maxrate', '4M',  # Lower maximum bitrate
                     '-bufsize', '4M',  # Buffer size
                     '-preset', 'slow',  # Slower preset for better compression
-                    '-af', 'loudnorm=I=-23:LRA=7:TP=-2',
+                    '-af', audio_filter,
                     '-ar', '44100',
                     '-c:a', 'aac',
                     '-b:a', '128k',
@@ -104,58 +125,91 @@ def normalize_audio(directory):
                 ]
         elif mode == 'processtv':
             # Resize to 1080p if larger and re-encode with lower quality
-            scale_filter = ''
+            preset = 'processtv'
+            scale_args = []
             if original_resolution and (original_resolution[0] > 1920 or original_resolution[1] > 1080):
-                scale_filter = '-vf scale=1920:1080'
+                scale_args = ['-vf', 'scale=1920:1080']
 
-            command = [
-                ffmpeg_path,
-                '-hwaccel', 'cuda',
-                '-i', backup_file,
+            video_args = [
                 '-c:v', 'hevc_nvenc',
                 '-b:v', '1M',  # Lower target average bitrate for old TV shows
                 '-maxrate', '2M',  # Lower maximum bitrate
                 '-bufsize', '2M',  # Buffer size
                 '-preset', 'slow',  # Slower preset for better compression
-                '-af', 'loudnorm=I=-23:LRA=7:TP=-2',
+            ] + scale_args
+            audio_args = [
+                '-af', audio_filter,
                 '-ar', '44100',
                 '-c:a', 'aac',
                 '-b:a', '96k',  # Lower audio bitrate for old TV shows
+            ]
+            command = [
+                ffmpeg_path, '-y',
+                '-hwaccel', 'cuda',
+                '-i', backup_file,
+                '-threads', threads,
+            ] + video_args + audio_args + [
                 '-c:s', 'copy',  # Copy subtitle streams
-                scale_filter,
                 normalized_file
             ]
 
+            # Long episodes are cut at keyframes and encoded a few segments at a time
+            if segment_seconds and media_info and media_info.duration and media_info.duration >= 2 * segment_seconds:
+                segmented = True
+
+        # Record the job before touching the file so an interrupted run can be resumed
+        settings = [arg for arg in command[1:] if arg not in (backup_file, normalized_file)]
+        if segmented:
+            settings += ['--segment-seconds', str(segment_seconds)]
+        manifest.start(full_path, input_fingerprint, backup_file, mode, settings)
+        shutil.move(full_path, backup_file)
+        duration = media_info.duration if media_info else None
+        job_progress = progress.start(file, duration)
         try:
-            subprocess.run(command, check=True)
-            os.rename(normalized_file, full_path)
-            logging.debug(f"Completed processing on {file}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error processing file {file}: {e}")
-
-    if sys.argv[1] == 'process':
-        process_directory(directory)
-        with open(last_run_file, 'w') as file:
-            file.write(datetime.datetime.now().isoformat())
-        logging.debug("Updated last run time.")
-
-    elif sys.argv[1] == 'processtv':
-        process_directory(directory)
-        with open(last_run_file, 'w') as file:
-            file.write(datetime.datetime.now().isoformat())
-        logging.debug("Updated last run time.")
-
-    elif sys.argv[1] == 'undo':
-        undo_changes(directory)
-        if os.path.exists(last_run_file):
-            os.remove(last_run_file)
-            logging.debug("Removed last run tracking file.")
-
-    elif sys.argv[1] == 'finalize':
-        finalize_changes(directory)
+            if segmented:
+                logging.debug(f"Encoding {file} in {segment_seconds}s segments")
+                encode_segmented(ffmpeg_path, backup_file, normalized_file, video_args, audio_args, segment_seconds,
+                                 segment_jobs=segment_jobs, input_args=['-hwaccel', 'cuda'],
+                                 threads=threads_per_job(jobs * segment_jobs), progress=job_progress.update)
+            else:
+                run_ffmpeg(command, progress=job_progress.update)
+        except Exception:
+            # Put the original back so a failed job leaves the library as it was
+            if os.path.exists(normalized_file):
+                os.remove(normalized_file)
+            shutil.move(backup_file, full_path)
+            manifest.forget(full_path)
+            raise
+        finally:
+            progress.finish(job_progress)
+        os.rename(normalized_file, full_path)
+        manifest.finish(full_path)
+        metrics.write(file, preset, os.path.getsize(backup_file), os.path.getsize(full_path), duration, job_progress.elapsed())
+        logging.debug(f"Completed processing on {file}")
 
-    else:
-        logging.error("Invalid command. Usage: recursive_normalize.py [process|processtv|undo|finalize]")
+    # Originals of those runs that the manifest doesn't know about are found by walking the tree
+    try:
+        if mode == 'process':
+            process_directory(directory, 'normalize')
+
+        elif mode == 'processtv':
+            process_directory(directory, 'processtv')
+
+        elif mode == 'undo':
+            undo_from_manifest(manifest, log=logging.debug)
+            if os.path.exists(last_run_file):
+                undo_changes(directory)
+                os.remove(last_run_file)
+                logging.debug("Removed last run tracking file.")
+
+        elif mode == 'finalize':
+            finalize_from_manifest(manifest, log=logging.debug)
+            if os.path.exists(last_run_file):
+                finalize_changes(directory)
+                os.remove(last_run_file)
+                logging.debug("Removed last run tracking file.")
+    finally:
+        manifest.close()
 
 def undo_changes(current_directory):
     original_dir = os.path.join(current_directory, 'original')
@@ -192,6 +246,13 @@ def finalize_changes(current_directory):
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        logging.error("Usage: recursive_normalize.py [process|processtv|undo|finalize]")
+        logging.error("Usage: recursive_normalize.py [process|processtv|undo|finalize] [--jobs N] [--segment-seconds S]")
     else:
-        normalize_audio('.')
+        parser = argparse.ArgumentParser(description='Normalize audio and re-encode videos to HEVC in place, keeping the originals.')
+        parser.add_argument('mode', help='process, processtv, undo or finalize')
+        parser.add_argument('--jobs', type=int, default=1, help='Number of ffmpeg encodes run at once')
+        parser.add_argument('--segment-seconds', type=int, default=0,
+                            help='processtv only: encode files at least twice this long as keyframe-aligned segments of about this many seconds (0 = single pass)')
+        parser.add_argument('--segment-jobs', type=int, default=4, help='Number of segments of one file encoded at once')
+        args = parser.parse_args()
+        normalize_audio('.', args.mode, jobs=args.jobs, segment_seconds=args.segment_seconds, segment_jobs=args.segment_jobs)
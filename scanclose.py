@@ -5,44 +5,47 @@ import difflib
 import shutil
 import argparse
 import html
+import csv
+import json
+import hashlib
+import sys
+import ctypes
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from collections import Counter, defaultdict
+from popper_db import get_pool
 
 # Function to fetch table filenames from the SQLite database
 def fetch_table_filenames(database_path, debug=False):
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
+    db = get_pool(database_path)
 
-    cursor.execute("PRAGMA table_info(emulators);")
-    emulator_columns = [column[1] for column in cursor.fetchall()]
+    emulator_columns = db.columns('emulators')
     if debug:
         print(f"Columns in emulators table: {emulator_columns}")
 
-    id_column = 'EMUID' if 'EMUID' in emulator_columns else emulator_columns[0]
-    name_column = 'EmuName' if 'EmuName' in emulator_columns else emulator_columns[1]
+    id_column = db.column('emulators', 'EMUID', 0)
+    name_column = db.column('emulators', 'EmuName', 1)
 
-    cursor.execute(f"SELECT {id_column} FROM emulators WHERE {name_column} LIKE '%Visual Pinball%'")
-    visual_pinball_ids = [row[0] for row in cursor.fetchall()]
+    visual_pinball_ids = db.query_values(f"SELECT {id_column} FROM emulators WHERE {name_column} LIKE '%Visual Pinball%'")
 
     if not visual_pinball_ids:
         print("No Visual Pinball emulators found.")
-        conn.close()
         return []
 
-    cursor.execute("PRAGMA table_info(Games);")
-    game_columns = [column[1] for column in cursor.fetchall()]
+    game_columns = db.columns('Games')
     if debug:
         print(f"Columns in Games table: {game_columns}")
 
-    game_filename_column = 'GameFileName' if 'GameFileName' in game_columns else game_columns[0]
-    emulator_id_column = 'EMUID' if 'EMUID' in game_columns else game_columns[1]
+    game_filename_column = db.column('Games', 'GameFileName', 0)
+    emulator_id_column = db.column('Games', 'EMUID', 1)
 
     placeholder = ', '.join(['?'] * len(visual_pinball_ids))
-    cursor.execute(f"SELECT {game_filename_column} FROM Games WHERE {emulator_id_column} IN ({placeholder}) ORDER BY {game_filename_column}", visual_pinball_ids)
-    table_filenames = [os.path.splitext(row[0])[0] for row in cursor.fetchall() if row[0] and row[0].strip()]
+    game_filenames = db.query_values(f"SELECT {game_filename_column} FROM Games WHERE {emulator_id_column} IN ({placeholder}) ORDER BY {game_filename_column}", visual_pinball_ids)
+    table_filenames = [os.path.splitext(filename)[0] for filename in game_filenames if filename and filename.strip()]
 
     if debug:
         print(f"Visual Pinball table filenames: {table_filenames}")
 
-    conn.close()
     return table_filenames
 
 # Function to clean and standardize filenames by removing common extraneous details
@@ -53,19 +56,135 @@ def clean_filename(filename):
     cleaned_filename = re.sub(r'[-_]', ' ', cleaned_filename)
     return cleaned_filename.strip()
 
+# Lower bound on the n-grams two strings must share for SequenceMatcher.ratio() to reach threshold.
+# A ratio r over total length T needs M >= r*T/2 matched characters split into at most
+# T - 2M + 1 blocks, and each block of m characters shares at least m - (n - 1) n-grams.
+def min_shared_ngrams(len_a, len_b, threshold, ngram=2):
+    total = len_a + len_b
+    matched = threshold * total / 2
+    blocks = total - 2 * matched + 1
+    return matched - (ngram - 1) * blocks
+
+# Cleans the table list once and indexes it by character n-grams so each media file
+# is only scored against tables that can possibly reach the threshold
+class TableMatcher:
+    def __init__(self, table_filenames, ngram=2):
+        self.table_filenames = list(table_filenames)
+        self.ngram = ngram
+        self.cleaned = [clean_filename(name) for name in self.table_filenames]
+        self.index = defaultdict(list)
+        self.by_length = defaultdict(list)
+        self.matchers = []
+        self.cache = {}
+
+        for i, cleaned in enumerate(self.cleaned):
+            for gram, count in Counter(self.ngrams(cleaned)).items():
+                self.index[gram].append((i, count))
+            self.by_length[len(cleaned)].append(i)
+            matcher = difflib.SequenceMatcher(None)
+            matcher.set_seq2(cleaned)
+            self.matchers.append(matcher)
+
+    def ngrams(self, text):
+        return [text[i:i + self.ngram] for i in range(len(text) - self.ngram + 1)]
+
+    def candidates(self, cleaned_filename, threshold):
+        query_length = len(cleaned_filename)
+        shared = defaultdict(int)
+        for gram, count in Counter(self.ngrams(cleaned_filename)).items():
+            for i, table_count in self.index.get(gram, ()):
+                shared[i] += min(count, table_count)
+
+        candidates = [i for i, count in shared.items()
+                      if count >= min_shared_ngrams(query_length, len(self.cleaned[i]), threshold, self.ngram) - 1e-9]
+
+        # Very short names can reach the threshold without sharing a single n-gram
+        for table_length, indices in self.by_length.items():
+            if min_shared_ngrams(query_length, table_length, threshold, self.ngram) <= 1e-9:
+                candidates.extend(i for i in indices if i not in shared)
+
+        return sorted(candidates)
+
+    def find_best_matches(self, filename, threshold=0.90, debug=False):
+        cleaned_filename = clean_filename(filename)
+        cache_key = (cleaned_filename, threshold)
+        if not debug and cache_key in self.cache:
+            return list(self.cache[cache_key])
+
+        # Debug output reports every comparison of 80% or better, so widen the candidate set to match
+        floor = min(threshold, 0.80) if debug else threshold
+        matches = []
+        for i in self.candidates(cleaned_filename, floor):
+            matcher = self.matchers[i]
+            matcher.set_seq1(cleaned_filename)
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            similarity = matcher.ratio()
+            if similarity >= 0.80 and debug:
+                print(f"Comparing '{cleaned_filename}' with '{self.cleaned[i]}' - Similarity: {similarity:.2f}")
+            if similarity >= threshold:
+                matches.append((similarity, self.table_filenames[i]))
+        matches.sort(reverse=True, key=lambda x: x[0])
+        self.cache[cache_key] = matches
+        return list(matches)
+
 # Function to find the best match with similarity score
 def find_best_matches(filename, table_filenames, threshold=0.90, debug=False):
-    cleaned_filename = clean_filename(filename)
-    matches = []
+    if not isinstance(table_filenames, TableMatcher):
+        table_filenames = TableMatcher(table_filenames)
+    return table_filenames.find_best_matches(filename, threshold, debug=debug)
+
+# Function to fingerprint the table list so cached matches are dropped whenever the Games table changes
+def table_fingerprint(table_filenames, threshold=0.90):
+    digest = hashlib.sha1(f"{threshold!r}".encode("utf-8"))
     for table_filename in table_filenames:
-        cleaned_table_filename = clean_filename(table_filename)
-        similarity = difflib.SequenceMatcher(None, cleaned_filename, cleaned_table_filename).ratio()
-        if similarity >= 0.80 and debug:
-            print(f"Comparing '{cleaned_filename}' with '{cleaned_table_filename}' - Similarity: {similarity:.2f}")
-        if similarity >= threshold:
-            matches.append((similarity, table_filename))
-    matches.sort(reverse=True, key=lambda x: x[0])
-    return matches
+        digest.update(b"\0" + table_filename.encode("utf-8"))
+    return digest.hexdigest()
+
+# On-disk SQLite cache of match results keyed by media file name and table list fingerprint
+class MatchCache:
+    def __init__(self, cache_path, fingerprint):
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS matches (file_name TEXT NOT NULL, fingerprint TEXT NOT NULL, matches TEXT NOT NULL, PRIMARY KEY (file_name, fingerprint))")
+        self.conn.execute("DELETE FROM matches WHERE fingerprint != ?", (fingerprint,))
+        self.conn.commit()
+
+    def get(self, file_name):
+        row = self.conn.execute("SELECT matches FROM matches WHERE file_name = ? AND fingerprint = ?", (file_name, self.fingerprint)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(match) for match in json.loads(row[0])]
+
+    def put(self, file_name, matches):
+        self.conn.execute("INSERT OR REPLACE INTO matches (file_name, fingerprint, matches) VALUES (?, ?, ?)", (file_name, self.fingerprint, json.dumps(matches)))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# Each worker process builds its own TableMatcher once from the table list passed to the pool initializer
+worker_matcher = None
+
+def init_match_worker(table_filenames):
+    global worker_matcher
+    worker_matcher = TableMatcher(table_filenames)
+
+def match_chunk(file_names, threshold, debug):
+    return [worker_matcher.find_best_matches(file_name, threshold, debug=debug) for file_name in file_names]
+
+# Function to match many file names across a process pool, returning results in input order
+def match_media_files(file_names, matcher, threshold=0.90, debug=False, jobs=1, chunk_size=256):
+    if jobs <= 1:
+        return [matcher.find_best_matches(file_name, threshold, debug=debug) for file_name in file_names]
+
+    chunks = [file_names[i:i + chunk_size] for i in range(0, len(file_names), chunk_size)]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_match_worker, initargs=(matcher.table_filenames,)) as executor:
+        return [matches for chunk in executor.map(match_chunk, chunks, repeat(threshold), repeat(debug)) for matches in chunk]
 
 # Function to ensure unique filenames in the backup directory
 def ensure_unique_filename(directory, filename):
@@ -77,8 +196,308 @@ def ensure_unique_filename(directory, filename):
         counter += 1
     return unique_filename
 
+# Function to clone a file with copy-on-write extents, returning False when the platform or volume can't
+def reflink(source, target):
+    if sys.platform.startswith("linux"):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(source, "rb") as source_file, open(target, "xb") as target_file:
+                try:
+                    fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+                    return True
+                except OSError:
+                    pass
+        except OSError:
+            return False
+        os.remove(target)
+        return False
+    if sys.platform == "darwin":
+        libc = ctypes.CDLL(None, use_errno=True)
+        return hasattr(libc, "clonefile") and libc.clonefile(os.fsencode(source), os.fsencode(target), 0) == 0
+    return False
+
+# Function to duplicate a media file as cheaply as the link mode allows: a reflink, then a hardlink
+# on the same volume, and a full copy only when neither works. Returns the method that was used.
+def link_or_copy(source, target, link_mode="copy"):
+    if link_mode == "reflink" and reflink(source, target):
+        shutil.copystat(source, target)
+        return "reflink"
+    if link_mode in ("reflink", "hardlink"):
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+    return "copy"
+
+# Function to print how many bytes the link mode saved over full copies
+def print_link_summary(link_stats):
+    print(f"Link mode: {link_stats['reflink']} reflinks, {link_stats['hardlink']} hardlinks, {link_stats['copy']} copies, "
+          f"{link_stats['BytesSaved'] / (1024 * 1024):.1f} MB saved")
+
+# Streams the dry run actions to a plan that --apply-plan can execute later.
+# Each action records the size and mtime of its source file as a precondition.
+class PlanWriter:
+    def __init__(self, plan_path, media_dir, backup_dir):
+        self.plan_file = open(plan_path, "w", encoding="utf-8")
+        self.plan_file.write(f'{{"media_dir": {json.dumps(media_dir)}, "backup_dir": {json.dumps(backup_dir)}, "actions": [')
+        self.count = 0
+
+    def add(self, row):
+        action, table_filename, source, target, match = row
+        entry = {"action": action, "table": table_filename, "source": source, "target": target, "match": match}
+        try:
+            stat = os.stat(source)
+            entry["size"] = stat.st_size
+            entry["mtime_ns"] = stat.st_mtime_ns
+        except OSError:
+            entry["size"] = None
+            entry["mtime_ns"] = None
+        self.plan_file.write(("," if self.count else "") + "\n" + json.dumps(entry))
+        self.count += 1
+
+    def close(self):
+        self.plan_file.write("\n]}\n")
+        self.plan_file.close()
+
+# Function to check that a planned source file is still the one that was reviewed
+def plan_precondition_holds(path, entry):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+
+# Function to apply the planned actions of a single source directory in plan order
+def apply_plan_batch(entries, debug=False, link_mode="copy"):
+    applied = Counter()
+    skipped = []
+    renamed = {}
+
+    for entry in entries:
+        action = entry["action"]
+        # A copy planned from a file that this plan already renamed follows the rename
+        source = renamed.get(entry["source"], entry["source"])
+        target = entry["target"]
+
+        if not plan_precondition_holds(source, entry):
+            skipped.append((entry, "source file is missing or has changed since the dry run"))
+            continue
+
+        if action == "Rename":
+            if os.path.exists(target):
+                skipped.append((entry, "target already exists"))
+                continue
+            os.rename(source, target)
+            renamed[entry["source"]] = target
+        elif action == "Copy":
+            if os.path.exists(target):
+                skipped.append((entry, "target already exists"))
+                continue
+            method = link_or_copy(source, target, link_mode)
+            applied[method] += 1
+            if method != "copy":
+                applied["BytesSaved"] += entry["size"]
+        elif action == "Move":
+            backup_path = os.path.dirname(target)
+            os.makedirs(backup_path, exist_ok=True)
+            target = os.path.join(backup_path, ensure_unique_filename(backup_path, os.path.basename(target)))
+            shutil.move(source, target)
+        else:
+            continue
+
+        if debug:
+            print(f"{action}: {source} -> {target}")
+        applied[action] += 1
+
+    return applied, skipped
+
+# Function to execute a saved dry run plan, batching actions by directory across a thread pool
+def apply_action_plan(plan_path, jobs=8, debug=False, link_mode="copy"):
+    with open(plan_path, "r", encoding="utf-8") as plan_file:
+        plan = json.load(plan_file)
+
+    batches = defaultdict(list)
+    left = 0
+    for entry in plan["actions"]:
+        if entry["action"] == "Leave":
+            left += 1
+        else:
+            batches[os.path.dirname(entry["source"])].append(entry)
+
+    applied = Counter()
+    skipped = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for batch_applied, batch_skipped in executor.map(apply_plan_batch, batches.values(), repeat(debug), repeat(link_mode)):
+            applied.update(batch_applied)
+            skipped.extend(batch_skipped)
+
+    for entry, reason in skipped:
+        print(f"Skipped {entry['action']} of {entry['source']}: {reason}")
+
+    print("\nPlan Summary:")
+    print(f"Renamed: {applied['Rename']}, Copied: {applied['Copy']}, BackedUp: {applied['Move']}, Left: {left}, Skipped: {len(skipped)}")
+    print_link_summary(applied)
+    return applied, skipped
+
+REPORT_COLUMNS = ["Action", "Table Filename", "Original File Name", "Replacement File Name", "% Match"]
+
+# Streams report rows to disk as actions are produced so memory stays flat however many there are.
+# The html format writes the rows to paged sidecar files under <report>_data that the page loads
+# on demand; csv and jsonl write a single file for scripting.
+class ReportWriter:
+    def __init__(self, report_format="html", report_path=None, page_size=1000):
+        self.report_format = report_format
+        self.report_path = report_path or f"report.{report_format}"
+        self.data_dir = os.path.splitext(self.report_path)[0] + "_data"
+        self.page_size = page_size
+        self.page = []
+        self.rows = 0
+
+        # Delete the old report if it exists
+        if os.path.exists(self.report_path):
+            os.remove(self.report_path)
+
+        if report_format == "html":
+            if os.path.isdir(self.data_dir):
+                shutil.rmtree(self.data_dir)
+            os.makedirs(self.data_dir)
+        else:
+            self.report_file = open(self.report_path, "w", encoding="utf-8", newline="")
+            if report_format == "csv":
+                self.csv_writer = csv.writer(self.report_file)
+                self.csv_writer.writerow(REPORT_COLUMNS)
+
+    def add(self, row):
+        self.rows += 1
+        if self.report_format == "html":
+            self.page.append(row)
+            if len(self.page) == self.page_size:
+                self.flush_page()
+        elif self.report_format == "csv":
+            self.csv_writer.writerow(row)
+        else:
+            self.report_file.write(json.dumps(dict(zip(REPORT_COLUMNS, row))) + "\n")
+
+    def flush_page(self):
+        page_number = (self.rows - 1) // self.page_size
+        page_path = os.path.join(self.data_dir, f"page_{page_number:05d}.js")
+        # Wrapped in a function call so the browser can load it from file:// with a script tag
+        with open(page_path, "w", encoding="utf-8") as page_file:
+            page_file.write(f"reportPage({page_number}, {json.dumps(self.page)});\n")
+        self.page = []
+
+    def close(self, summary, total_summary):
+        if self.report_format != "html":
+            self.report_file.close()
+            return
+
+        if self.page:
+            self.flush_page()
+
+        with open(self.report_path, "w", encoding="utf-8") as report_file:
+            report_file.write("""
+<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<link rel="stylesheet" href="https://cdn.datatables.net/1.10.21/css/jquery.dataTables.min.css">
+<link rel="stylesheet" href="https://cdn.datatables.net/buttons/1.7.1/css/buttons.dataTables.min.css">
+<script src="https://code.jquery.com/jquery-3.5.1.js"></script>
+<script src="https://cdn.datatables.net/1.10.21/js/jquery.dataTables.min.js"></script>
+<script src="https://cdn.datatables.net/buttons/1.7.1/js/dataTables.buttons.min.js"></script>
+<script src="https://cdn.datatables.net/buttons/1.7.1/js/buttons.html5.min.js"></script>
+<script src="https://cdn.datatables.net/buttons/1.7.1/js/buttons.print.min.js"></script>
+<title>Media Processing Report</title>
+</head>
+<body>
+<div class="container">
+<h2>Media Processing Report</h2>
+<table id="report" class="table table-striped table-bordered" style="width:100%">
+<thead>
+<tr>
+<th>Action</th>
+<th>Table Filename</th>
+<th>Original File Name</th>
+<th>Replacement File Name</th>
+<th>% Match</th>
+</tr>
+</thead>
+</table>
+<script>
+var reportRows = """ + str(self.rows) + """;
+var pageSize = """ + str(self.page_size) + """;
+var dataDir = """ + json.dumps(os.path.basename(self.data_dir)) + """;
+var pages = {};
+var waiting = {};
+function reportPage(number, rows) {
+    pages[number] = rows;
+    (waiting[number] || []).forEach(function(callback) { callback(rows); });
+    delete waiting[number];
+}
+function loadPage(number, callback) {
+    if (pages[number]) { callback(pages[number]); return; }
+    if (waiting[number]) { waiting[number].push(callback); return; }
+    waiting[number] = [callback];
+    var script = document.createElement('script');
+    script.src = dataDir + '/page_' + ('0000' + number).slice(-5) + '.js';
+    document.head.appendChild(script);
+}
+$(document).ready(function() {
+$('#report').DataTable({
+    dom: 'Bfrtip',
+    buttons: [
+        'copy', 'print'
+    ],
+    serverSide: true,
+    searching: false,
+    ordering: false,
+    lengthChange: false,
+    pageLength: pageSize,
+    columnDefs: [{targets: '_all', render: $.fn.dataTable.render.text()}],
+    ajax: function(data, callback) {
+        var number = Math.floor(data.start / pageSize);
+        if (reportRows === 0) {
+            callback({draw: data.draw, recordsTotal: 0, recordsFiltered: 0, data: []});
+            return;
+        }
+        loadPage(number, function(rows) {
+            callback({draw: data.draw, recordsTotal: reportRows, recordsFiltered: reportRows, data: rows});
+        });
+    }
+});
+});
+</script>
+<h3>Summary:</h3>
+<table class="table table-striped table-bordered" style="width:100%">
+<thead>
+<tr>
+<th>Media Type</th>
+<th>Processed</th>
+<th>Copied</th>
+<th>Renamed</th>
+<th>BackedUp</th>
+<th>Left</th>
+</tr>
+</thead>
+<tbody>
+""")
+            for key, value in summary.items():
+                report_file.write(f"<tr><td>{html.escape(key)}</td><td>{value['Processed']}</td><td>{value['Copied']}</td><td>{value['Renamed']}</td><td>{value['BackedUp']}</td><td>{value['Left']}</td></tr>")
+            report_file.write(f"<tr><td>Total</td><td>{total_summary['Processed']}</td><td>{total_summary['Copied']}</td><td>{total_summary['Renamed']}</td><td>{total_summary['BackedUp']}</td><td>{total_summary['Left']}</td></tr>")
+            report_file.write("""
+</tbody>
+</table>
+</div>
+</body>
+</html>
+""")
+
 # Function to process media files
-def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry_run=True, threshold=0.90, debug=False):
+def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry_run=True, threshold=0.90, debug=False, jobs=1, cache=None, plan_path=None, report=None, link_mode="copy"):
     summary = {
         "Audio": {"Processed": 0, "Copied": 0, "Renamed": 0, "BackedUp": 0, "Left": 0},
         "AudioLaunch": {"Processed": 0, "Copied": 0, "Renamed": 0, "BackedUp": 0, "Left": 0},
@@ -97,9 +516,38 @@ def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry
     }
     total_summary = {"Processed": 0, "Copied": 0, "Renamed": 0, "BackedUp": 0, "Left": 0}
 
-    actions = []
-
-    for root, _, files in sorted(os.walk(media_dir), key=lambda x: x[0]):
+    if report is None:
+        report = ReportWriter()
+    plan = PlanWriter(plan_path, media_dir, backup_dir) if dry_run and plan_path else None
+
+    def record(row):
+        report.add(row)
+        if plan is not None:
+            plan.add(row)
+
+    link_stats = Counter()
+    matcher = table_filenames if isinstance(table_filenames, TableMatcher) else TableMatcher(table_filenames)
+
+    walk = sorted(os.walk(media_dir), key=lambda x: x[0])
+
+    # Matching is pure CPU work, so with several jobs it is done up front and the
+    # file actions below are still applied one by one in the usual order
+    precomputed = {}
+    if jobs > 1:
+        file_names = sorted({os.path.splitext(file)[0] for _, _, files in walk for file in files
+                             if any(file.endswith(ext) for ext in media_types)})
+        if cache is not None:
+            for file_name in file_names:
+                matches = cache.get(file_name)
+                if matches is not None:
+                    precomputed[file_name] = matches
+            file_names = [file_name for file_name in file_names if file_name not in precomputed]
+        for file_name, matches in zip(file_names, match_media_files(file_names, matcher, threshold, debug=debug, jobs=jobs)):
+            precomputed[file_name] = matches
+            if cache is not None:
+                cache.put(file_name, matches)
+
+    for root, _, files in walk:
         if debug:
             print(f"\nProcessing directory: {root}")
             print(f"Number of files: {len(files)}")
@@ -109,7 +557,14 @@ def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry
                 file_path = os.path.join(root, file)
                 original_file_path = file_path  # Track the original file path
                 file_name = os.path.splitext(file)[0]
-                matches = find_best_matches(file_name, table_filenames, threshold, debug=debug)
+                if file_name in precomputed:
+                    matches = precomputed[file_name]
+                else:
+                    matches = cache.get(file_name) if cache is not None else None
+                    if matches is None:
+                        matches = matcher.find_best_matches(file_name, threshold, debug=debug)
+                        if cache is not None:
+                            cache.put(file_name, matches)
                 media_type = next((key for key in summary if key in root), "Other")
 
                 summary[media_type]["Processed"] += 1
@@ -122,13 +577,13 @@ def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry
                     if confidence >= 95 and best_match != file_name:
                         if new_file_path != file_path:
                             if dry_run:
-                                actions.append(["Rename", best_match, file_path, new_file_path, f"{confidence:.2f}%"])
+                                record(["Rename", best_match, file_path, new_file_path, f"{confidence:.2f}%"])
                                 summary[media_type]["Renamed"] += 1
                                 total_summary["Renamed"] += 1
                             else:
                                 if not os.path.exists(new_file_path):
                                     os.rename(file_path, new_file_path)
-                                    actions.append(["Rename", best_match, file_path, new_file_path, f"{confidence:.2f}%"])
+                                    record(["Rename", best_match, file_path, new_file_path, f"{confidence:.2f}%"])
                                     summary[media_type]["Renamed"] += 1
                                     total_summary["Renamed"] += 1
                                     file_path = new_file_path  # Update file_path to the new path
@@ -139,17 +594,20 @@ def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry
                         for match in matches[1:]:
                             copy_name = os.path.join(root, match[1] + os.path.splitext(file)[1])
                             if dry_run:
-                                actions.append(["Copy", match[1], original_file_path, copy_name, f"{match[0]*100:.2f}%"])
+                                record(["Copy", match[1], original_file_path, copy_name, f"{match[0]*100:.2f}%"])
                                 summary[media_type]["Copied"] += 1
                                 total_summary["Copied"] += 1
                             else:
                                 if os.path.exists(original_file_path) and not os.path.exists(copy_name):
-                                    shutil.copy2(original_file_path, copy_name)
-                                    actions.append(["Copy", match[1], original_file_path, copy_name, f"{match[0]*100:.2f}%"])
+                                    method = link_or_copy(original_file_path, copy_name, link_mode)
+                                    link_stats[method] += 1
+                                    if method != "copy":
+                                        link_stats["BytesSaved"] += os.path.getsize(original_file_path)
+                                    record(["Copy", match[1], original_file_path, copy_name, f"{match[0]*100:.2f}%"])
                                     summary[media_type]["Copied"] += 1
                                     total_summary["Copied"] += 1
                     else:
-                        actions.append(["Leave", best_match, file_path, "", f"{confidence:.2f}%"])
+                        record(["Leave", best_match, file_path, "", f"{confidence:.2f}%"])
                         summary[media_type]["Left"] += 1
                         total_summary["Left"] += 1
                 else:
@@ -157,109 +615,48 @@ def process_media_files(media_dir, table_filenames, media_types, backup_dir, dry
                     backup_path = os.path.join(backup_dir, backup_subdir)
                     if dry_run:
                         backup_filename = ensure_unique_filename(backup_path, os.path.basename(file_path))
-                        actions.append(["Move", "", file_path, os.path.join(backup_path, backup_filename), "No close matches found"])
+                        record(["Move", "", file_path, os.path.join(backup_path, backup_filename), "No close matches found"])
                         summary[media_type]["BackedUp"] += 1
                         total_summary["BackedUp"] += 1
                     else:
                         os.makedirs(backup_path, exist_ok=True)
                         backup_filename = ensure_unique_filename(backup_path, os.path.basename(file_path))
                         shutil.move(file_path, os.path.join(backup_path, backup_filename))
-                        actions.append(["Move", "", file_path, os.path.join(backup_path, backup_filename), "No close matches found"])
+                        record(["Move", "", file_path, os.path.join(backup_path, backup_filename), "No close matches found"])
                         summary[media_type]["BackedUp"] += 1
                         total_summary["BackedUp"] += 1
 
-    # Delete old report.html if it exists
-    if os.path.exists("report.html"):
-        os.remove("report.html")
-
-    # Generate HTML report
-    html_content = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<link rel="stylesheet" href="https://cdn.datatables.net/1.10.21/css/jquery.dataTables.min.css">
-<link rel="stylesheet" href="https://cdn.datatables.net/buttons/1.7.1/css/buttons.dataTables.min.css">
-<script src="https://code.jquery.com/jquery-3.5.1.js"></script>
-<script src="https://cdn.datatables.net/1.10.21/js/jquery.dataTables.min.js"></script>
-<script src="https://cdn.datatables.net/buttons/1.7.1/js/dataTables.buttons.min.js"></script>
-<script src="https://cdn.datatables.net/buttons/1.7.1/js/buttons.html5.min.js"></script>
-<script src="https://cdn.datatables.net/buttons/1.7.1/js/buttons.print.min.js"></script>
-<title>Media Processing Report</title>
-</head>
-<body>
-<div class="container">
-<h2>Media Processing Report</h2>
-<table id="report" class="table table-striped table-bordered" style="width:100%">
-<thead>
-<tr>
-<th>Action</th>
-<th>Table Filename</th>
-<th>Original File Name</th>
-<th>Replacement File Name</th>
-<th>% Match</th>
-</tr>
-</thead>
-<tbody>
-"""
-
-    for action in actions:
-        html_content += f"<tr><td>{html.escape(action[0])}</td><td>{html.escape(action[1])}</td><td>{html.escape(action[2])}</td><td>{html.escape(action[3])}</td><td>{html.escape(action[4])}</td></tr>"
-
-    html_content += """
-</tbody>
-</table>
-<script>
-$(document).ready(function() {
-$('#report').DataTable({
-    dom: 'Bfrtip',
-    buttons: [
-        'copy', 'csv', 'excel', 'pdf', 'print'
-    ]
-});
-});
-</script>
-<h3>Summary:</h3>
-<table class="table table-striped table-bordered" style="width:100%">
-<thead>
-<tr>
-<th>Media Type</th>
-<th>Processed</th>
-<th>Copied</th>
-<th>Renamed</th>
-<th>BackedUp</th>
-<th>Left</th>
-</tr>
-</thead>
-<tbody>
-"""
-    for key, value in summary.items():
-        html_content += f"<tr><td>{html.escape(key)}</td><td>{value['Processed']}</td><td>{value['Copied']}</td><td>{value['Renamed']}</td><td>{value['BackedUp']}</td><td>{value['Left']}</td></tr>"
-    html_content += f"<tr><td>Total</td><td>{total_summary['Processed']}</td><td>{total_summary['Copied']}</td><td>{total_summary['Renamed']}</td><td>{total_summary['BackedUp']}</td><td>{total_summary['Left']}</td></tr>"
-
-    html_content += """
-</tbody>
-</table>
-</div>
-</body>
-</html>
-"""
-
-    with open("report.html", "w", encoding="utf-8") as report_file:
-        report_file.write(html_content)
+    if plan is not None:
+        plan.close()
+    report.close(summary, total_summary)
 
     print("\nSummary:")
     for key, value in summary.items():
         print(f"{key}: Processed: {value['Processed']}, Copied: {value['Copied']}, Renamed: {value['Renamed']}, BackedUp: {value['BackedUp']}, Left: {value['Left']}")
     print(f"\nTotal: Processed: {total_summary['Processed']}, Copied: {total_summary['Copied']}, Renamed: {total_summary['Renamed']}, BackedUp: {total_summary['BackedUp']}, Left: {total_summary['Left']}")
+    if not dry_run:
+        print_link_summary(link_stats)
+    if cache is not None:
+        print(f"Match cache: {cache.hits} hits, {cache.misses} misses")
 
 def main():
     parser = argparse.ArgumentParser(description='Rename or move media files based on matching table filenames.')
     parser.add_argument('--process-files', action='store_true', help='Process the files after reviewing the dry run output')
     parser.add_argument('--debug', action='store_true', help='Show detailed debug information for matches 80% or better')
+    parser.add_argument('--cache', default='scanclose_cache.db', help='SQLite file used to cache match results between runs')
+    parser.add_argument('--no-cache', action='store_true', help='Score every media file without reading or writing the match cache')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of worker processes used to match media files, or threads used to apply a plan')
+    parser.add_argument('--plan', default='plan.json', help='Where the dry run writes its machine-readable action plan')
+    parser.add_argument('--apply-plan', metavar='PLAN', help='Apply the actions of a saved dry run plan instead of matching again')
+    parser.add_argument('--link-mode', choices=['hardlink', 'reflink', 'copy'], default='copy', help='How extra matches of one media file are duplicated: reflink, then hardlink, falling back to a full copy')
+    parser.add_argument('--report-format', choices=['html', 'csv', 'jsonl'], default='html', help='Write a paged HTML report, or a single CSV/JSONL file for scripting')
     args = parser.parse_args()
 
+    if args.apply_plan:
+        apply_action_plan(args.apply_plan, jobs=args.jobs or 8, debug=args.debug, link_mode=args.link_mode)
+        print("\nPlan applied.")
+        return
+
     database_path = r"C:\vPinball\PinUPSystem\PUPDatabase.db"
     media_dir = r"C:\vPinball\PinUPSystem\POPMedia\Visual Pinball X"
     backup_dir = r"C:\vPinball\backupmedia\PinUPSystem\POPMedia\Visual Pinball X"
@@ -271,12 +668,18 @@ def main():
         return
 
     dry_run = not args.process_files
-    process_media_files(media_dir, table_filenames, media_types, backup_dir, dry_run=dry_run, threshold=0.90, debug=args.debug)
+    report = ReportWriter(args.report_format)
+    cache = None if args.no_cache else MatchCache(args.cache, table_fingerprint(table_filenames, threshold=0.90))
+    try:
+        process_media_files(media_dir, table_filenames, media_types, backup_dir, dry_run=dry_run, threshold=0.90, debug=args.debug, jobs=args.jobs or 1, cache=cache, plan_path=args.plan, report=report, link_mode=args.link_mode)
+    finally:
+        if cache is not None:
+            cache.close()
 
     if dry_run:
-        print("\nDry run complete. Review the report (report.html) before processing the files.")
+        print(f"\nDry run complete. Review the report ({report.report_path}) before processing the files, or run --apply-plan {args.plan} to apply exactly these actions.")
     else:
-        print("\nFile processing complete. Review the report (report.html) for details.")
+        print(f"\nFile processing complete. Review the report ({report.report_path}) for details.")
 
 if __name__ == "__main__":
     main()
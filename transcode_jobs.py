@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Shared by reencodemovies.py and recursive_normalize.py: runs a collected work list of ffmpeg
+# jobs a few at a time, recording failures per job instead of aborting the batch.
+
+class JobResult:
+    def __init__(self, name, seconds, error=None):
+        self.name = name
+        self.seconds = seconds
+        self.error = error
+
+# Function to split the machine's cores between concurrent jobs so they don't oversubscribe it
+def threads_per_job(jobs):
+    return max(1, (os.cpu_count() or 1) // max(jobs, 1))
+
+# Function to turn one block of ffmpeg's -progress output into seconds encoded, fps and speed
+def parse_progress(values):
+    try:
+        out_time = int(values.get('out_time_us', values.get('out_time_ms', ''))) / 1000000
+    except ValueError:
+        out_time = None
+    try:
+        fps = float(values.get('fps', ''))
+    except ValueError:
+        fps = None
+    try:
+        speed = float(values.get('speed', '').rstrip('x'))
+    except ValueError:
+        speed = None
+    return {'out_time': out_time, 'fps': fps, 'speed': speed, 'done': values.get('progress') == 'end'}
+
+# Function to run ffmpeg quietly, keeping the tail of its output for the error report. With a
+# progress callback, ffmpeg's -progress output is read from stdout and passed on block by block.
+def run_ffmpeg(command, progress=None):
+    if progress is None:
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+        if result.returncode != 0:
+            tail = '\n'.join(result.stderr.strip().splitlines()[-5:])
+            raise subprocess.CalledProcessError(result.returncode, command, stderr=tail)
+        return
+
+    process = subprocess.Popen(command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+    # Drain stderr on the side so a chatty ffmpeg can't block on a full pipe
+    stderr_tail = deque(maxlen=5)
+    reader = threading.Thread(target=lambda: stderr_tail.extend(line.rstrip() for line in process.stderr if line.strip()), daemon=True)
+    reader.start()
+    values = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        values[key] = value
+        if key == 'progress':
+            progress(parse_progress(values))
+            values = {}
+    process.wait()
+    reader.join()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr='\n'.join(stderr_tail))
+
+def format_eta(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+# Live fps, speed and ETA for one ffmpeg job, reported through its BatchProgress
+class JobProgress:
+    def __init__(self, batch, name, duration):
+        self.batch = batch
+        self.name = name
+        self.duration = duration
+        self.start = time.perf_counter()
+        self.out_time = 0.0
+        self.fps = None
+        self.speed = None
+        self.last_log = 0.0
+
+    def fraction(self):
+        if not self.duration:
+            return 0.0
+        return min(self.out_time / self.duration, 1.0)
+
+    def eta(self):
+        if not self.duration or not self.speed:
+            return None
+        return max(self.duration - self.out_time, 0.0) / self.speed
+
+    def update(self, values):
+        if values['out_time'] is not None:
+            self.out_time = values['out_time']
+        self.fps = values['fps'] if values['fps'] is not None else self.fps
+        self.speed = values['speed'] if values['speed'] is not None else self.speed
+        self.batch.report(self)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+# Batch-wide view of the running jobs: each job logs its own fps, speed and ETA at most every
+# `interval` seconds, followed by how far the whole batch has got and its estimated time left.
+class BatchProgress:
+    def __init__(self, total_jobs, log=print, interval=10.0):
+        self.total_jobs = total_jobs
+        self.log = log
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.running = []
+        self.finished = 0
+
+    def start(self, name, duration):
+        job = JobProgress(self, name, duration)
+        with self.lock:
+            self.running.append(job)
+        return job
+
+    def finish(self, job):
+        with self.lock:
+            if job in self.running:
+                self.running.remove(job)
+            self.finished += 1
+
+    # Files that turn out to need no encode still count towards the batch
+    def skip(self):
+        with self.lock:
+            self.finished += 1
+
+    def batch_fraction(self):
+        done = self.finished + sum(job.fraction() for job in self.running)
+        return done / max(self.total_jobs, 1)
+
+    def report(self, job):
+        now = time.perf_counter()
+        with self.lock:
+            if now - job.last_log < self.interval:
+                return
+            job.last_log = now
+            fraction = self.batch_fraction()
+        elapsed = now - self.start_time
+        batch_eta = elapsed / fraction * (1 - fraction) if fraction > 0 else None
+        fps = f"{job.fps:.1f}" if job.fps is not None else '?'
+        speed = f"{job.speed:.2f}x" if job.speed is not None else '?'
+        self.log(f"{job.name}: {job.fraction() * 100:.1f}% fps={fps} speed={speed} ETA {format_eta(job.eta())} | "
+                 f"batch {self.finished}/{self.total_jobs} done, {fraction * 100:.1f}% ETA {format_eta(batch_eta)}")
+
+# Append-only JSONL log of finished encodes (sizes, media duration, encode time, compression ratio)
+# so bitrate and preset choices can be compared across runs. summary() covers this run only.
+class MetricsLog:
+    def __init__(self, metrics_path):
+        self.metrics_path = metrics_path
+        self.lock = threading.Lock()
+        self.records = []
+
+    def write(self, name, preset, input_bytes, output_bytes, duration, encode_seconds):
+        record = {
+            'file': name,
+            'preset': preset,
+            'input_bytes': input_bytes,
+            'output_bytes': output_bytes,
+            'duration': duration,
+            'encode_seconds': round(encode_seconds, 3),
+            'compression_ratio': round(input_bytes / output_bytes, 3) if output_bytes else None,
+            'speed': round(duration / encode_seconds, 3) if duration and encode_seconds else None,
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with self.lock:
+            with open(self.metrics_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+            self.records.append(record)
+
+    def summary(self, log=print):
+        presets = {}
+        for record in self.records:
+            presets.setdefault(record['preset'], []).append(record)
+        for preset, records in sorted(presets.items()):
+            input_bytes = sum(record['input_bytes'] for record in records)
+            output_bytes = sum(record['output_bytes'] for record in records)
+            duration = sum(record['duration'] or 0 for record in records)
+            encode_seconds = sum(record['encode_seconds'] for record in records)
+            realtime = f", {duration / max(encode_seconds, 1e-9):.2f}x realtime" if duration else ""
+            log(f"{preset}: {len(records)} files, {input_bytes / 1048576:.1f} MB -> {output_bytes / 1048576:.1f} MB "
+                f"(compression {input_bytes / max(output_bytes, 1):.2f}:1){realtime}")
+
+def run_job(worker, item):
+    start = time.perf_counter()
+    try:
+        worker(*item)
+        error = None
+    except Exception as e:
+        error = e
+    return JobResult(item[0], time.perf_counter() - start, error)
+
+# Function to run worker(*item) for every item, at most `jobs` at once, and report wall time against summed job time
+def run_jobs(work, worker, jobs=1, log=print):
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(run_job, worker, item) for item in work]
+        for future in as_completed(futures):
+            result = future.result()
+            if result.error is not None:
+                details = getattr(result.error, 'stderr', None)
+                log(f"Error processing file {result.name}: {result.error}" + (f"\n{details}" if details else ""))
+            results.append(result)
+    wall_time = time.perf_counter() - start
+
+    encode_time = sum(result.seconds for result in results)
+    failed = sum(1 for result in results if result.error is not None)
+    log(f"Processed {len(results)} files ({failed} failed) in {wall_time:.1f}s wall time, "
+        f"{encode_time:.1f}s summed encode time ({encode_time / max(wall_time, 1e-9):.1f}x)")
+    return results
+
+# Function to encode one long file as keyframe-aligned segments in parallel. The video is cut with
+# stream copy, each piece is encoded with video_args, the audio is encoded once over the whole file
+# with audio_args (so loudnorm sees the full programme) and everything is joined with stream copy.
+# The pieces live in a temporary directory outside the tree being scanned, so an interrupted run
+# never leaves them where the next run would pick them up.
+def encode_segmented(ffmpeg_path, source, output, video_args, audio_args, segment_seconds, segment_jobs=4, input_args=(), threads=None, progress=None):
+    segment_dir = tempfile.mkdtemp(prefix='segments_')
+    extension = os.path.splitext(output)[1]
+    try:
+        # The segment muxer only cuts at keyframes when copying, so every piece starts cleanly
+        run_ffmpeg([
+            ffmpeg_path, '-y',
+            '-i', source,
+            '-map', '0:v:0', '-c', 'copy',
+            '-f', 'segment', '-segment_time', str(segment_seconds), '-reset_timestamps', '1',
+            os.path.join(segment_dir, f'source_%05d{extension}')
+        ])
+        segments = sorted(name for name in os.listdir(segment_dir) if name.startswith('source_'))
+        thread_args = ['-threads', str(threads)] if threads else []
+
+        # Progress for the whole file is the encoded time summed over segments, at their combined fps and speed
+        segment_progress = {}
+        progress_lock = threading.Lock()
+
+        def segment_update(name, values):
+            with progress_lock:
+                segment_progress[name] = values
+                combined = {
+                    'out_time': sum(v['out_time'] or 0 for v in segment_progress.values()),
+                    'fps': sum(v['fps'] or 0 for v in segment_progress.values() if not v['done']) or None,
+                    'speed': sum(v['speed'] or 0 for v in segment_progress.values() if not v['done']) or None,
+                    'done': False,
+                }
+            progress(combined)
+
+        def encode_segment(name):
+            run_ffmpeg([ffmpeg_path, '-y'] + list(input_args) +
+                       ['-i', os.path.join(segment_dir, name)] + thread_args + list(video_args) +
+                       ['-an', os.path.join(segment_dir, name.replace('source_', 'encoded_', 1))],
+                       progress=(lambda values: segment_update(name, values)) if progress else None)
+
+        audio_file = os.path.join(segment_dir, 'audio.mka')
+        with ThreadPoolExecutor(max_workers=max(segment_jobs, 1)) as executor:
+            audio_future = executor.submit(run_ffmpeg, [ffmpeg_path, '-y', '-i', source, '-vn', '-sn'] + list(audio_args) + [audio_file])
+            # Iterating the results re-raises the first failed segment
+            list(executor.map(encode_segment, segments))
+            audio_future.result()
+
+        concat_list = os.path.join(segment_dir, 'concat.txt')
+        with open(concat_list, 'w', encoding='utf-8') as f:
+            for name in segments:
+                f.write(f"file '{name.replace('source_', 'encoded_', 1)}'\n")
+        run_ffmpeg([
+            ffmpeg_path, '-y',
+            '-f', 'concat', '-safe', '0', '-i', concat_list,
+            '-i', audio_file,
+            '-i', source,
+            '-map', '0:v', '-map', '1:a', '-map', '2:s?',
+            '-c', 'copy',
+            output
+        ])
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)